@@ -5,7 +5,11 @@
 # -------------------------------------------------------------------
 # - DESCRIPTION: Takes the subsetted grib files and creates
 #                combined NetCDF files (one netCDF file per
-#                model initialization/folder).
+#                model initialization/folder). The grib files
+#                are decoded using GFS_grib2.py and written into
+#                NetCDF4 files (netCDF4 python package); wgrib2 is
+#                only used for grids/packings GFS_grib2 does not
+#                support.
 # -------------------------------------------------------------------
 # - EDITORIAL:   2018-11-02, RS: Created file on pc24-c707.
 # -------------------------------------------------------------------
@@ -44,25 +48,609 @@ def get_netcdf_file_name(ncdir, date, postfix = None):
             date.strftime("%Y%m%d_%H%M"), postfix)) 
    
 
-   
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def get_variable_name(msg):
+   """get_variable_name(msg)
+
+   Name of the NetCDF variable for a grib message, the same as
+   used by "wgrib2 -netcdf": parameter and level without blanks,
+   "-" and "." replaced by "M" and "D", all other special characters
+   by "_" (e.g., "TMP_2maboveground" or, for "0-0.1 m below ground",
+   "TSOIL_0M0D1mbelowground").
+
+   Parameters
+   ----------
+   msg : GFS_grib2.grib2_message
+      the grib message
+
+   Returns
+   -------
+   Returns the variable name (str).
+   """
+   import re
+   level = msg.level().replace(" ", "").replace("-", "M").replace(".", "D")
+   return re.sub("[^A-Za-z0-9_]", "_", "{:s}_{:s}".format(msg.var(), level))
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def read_grib_files(grbfiles, skip = None):
+   """read_grib_files(grbfiles, skip = None)
+
+   Reads and decodes all messages of a set of grib files (e.g., the
+   subset files of one model run, one file per parameter and forecast
+   step) using GFS_grib2. The files are scanned first to get the
+   variables, the times, and the grid; the data are then decoded
+   directly into preallocated (time, latitude, longitude) arrays.
+   Raises a NotImplementedError if the files contain grids or packings
+   not supported by GFS_grib2 (see GFS_grib2.decode_grid).
+
+   Parameters
+   ----------
+   grbfiles : list
+      list of grib2 file names
+   skip : None or set
+      set of (variable name, forecast step) tuples which should not be
+      decoded (e.g., already stored in the NetCDF file, see get_netcdf_steps).
+
+   Returns
+   -------
+   Returns a dictionary with the model initialization ("date"), the
+   valid times ("time", list of datetime objects), "latitude" and
+   "longitude" (numpy.ndarray, latitudes increasing), and "variables",
+   a list of dictionaries with "name", "param", "level", "steps" (forecast
+   steps decoded, hours), and "data" (numpy.ndarray of dimension
+   (time, latitude, longitude), missing values are numpy.nan).
+   None if there are no (new) messages.
+   """
+   import mmap
+   import datetime as dt
+   import numpy as np
+   from GFS_grib2 import scan_grib2, decode_grid, decode_values
+
+   # (1) Scanning the files: variables, valid times, and grid
+   messages = []
+   grid     = None
+   for file in grbfiles:
+      msgs = scan_grib2(file)
+      if not skip is None:
+         msgs = [x for x in msgs if not (get_variable_name(x), x.step()) in skip]
+      if len(msgs) == 0: continue
+      with open(file, "rb") as fid:
+         buf = mmap.mmap(fid.fileno(), 0, access = mmap.ACCESS_READ)
+         try:
+            for msg in msgs:
+               tmp = decode_grid(buf, msg)
+               if grid is None:
+                  grid = tmp
+               elif not tmp == grid:
+                  raise ValueError("grid of {:s} differs from the other files".format(file))
+         finally:
+            buf.close()
+      messages.append((file, msgs))
+
+   if grid is None: return None
+   if not grid["scan"] in [0, 64]:
+      raise NotImplementedError("scanning mode {:d} not supported".format(grid["scan"]))
+
+   dates = np.unique([msg.date for file, msgs in messages for msg in msgs])
+   if not len(dates) == 1:
+      raise ValueError("files contain more than one model initialization")
+   date  = dates[0]
+   times = sorted(set([date + dt.timedelta(hours = msg.step()) \
+                       for file, msgs in messages for msg in msgs]))
+   tidx  = dict([(x, i) for i, x in enumerate(times)])
+
+   # Grid (latitudes increasing, as wgrib2 does)
+   nj, ni = grid["nj"], grid["ni"]
+   lons   = grid["lo1"] + np.arange(ni) * grid["di"]
+   lats   = grid["la1"] + np.arange(nj) * grid["dj"] * (1. if grid["scan"] == 64 else -1.)
+   flip   = grid["scan"] == 0
+
+   # (2) Decoding the data into the preallocated arrays
+   variables = {}
+   for file, msgs in messages:
+      with open(file, "rb") as fid:
+         buf = mmap.mmap(fid.fileno(), 0, access = mmap.ACCESS_READ)
+         try:
+            for msg in msgs:
+               name = get_variable_name(msg)
+               if not name in variables:
+                  variables[name] = {"name": name, "param": msg.var(), "level": msg.level(),
+                                     "steps": [],
+                                     "data": np.full((len(times), nj, ni), np.nan, dtype = np.float32)}
+               variables[name]["steps"].append(msg.step())
+               values = decode_values(buf, msg).reshape((nj, ni))
+               variables[name]["data"][tidx[date + dt.timedelta(hours = msg.step())]] = \
+                     values[::-1] if flip else values
+         finally:
+            buf.close()
+
+   return {"date": date, "time": times,
+           "latitude": lats[::-1] if flip else lats, "longitude": lons,
+           "variables": [variables[x] for x in sorted(variables.keys())]}
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def write_netcdf(ncfile, data, layout = "wgrib2", chunks = (4, 4), complevel = 4, shuffle = True):
+   """write_netcdf(ncfile, data, layout = "wgrib2", chunks = (4, 4), complevel = 4, shuffle = True)
+
+   Writes the data (see read_grib_files) into a NetCDF4 file. The time
+   is stored as seconds since 1970-01-01 00:00. The variables are
+   compressed and chunked such that each chunk contains all times for
+   a few grid points, reading the time series for a station only
+   requires a few chunks. The time dimension is unlimited, new forecast
+   steps can be added later on (see append_netcdf).
+
+   Two layouts are available:
+
+   * "wgrib2": the variables have the same names and dimensions as
+     written by "wgrib2 -netcdf" (time, latitude, longitude); the
+     forecast steps stored are listed in the "steps" attribute of each
+     variable. Used by GFS_interpolate.R.
+   * "stacked": one variable "data" (param, time, latitude, longitude)
+     containing all variables, the names are stored in "param", the
+     forecast steps stored in "present" (param, time). A chunk contains
+     all parameters and times for a few grid points.
+
+   Parameters
+   ----------
+   ncfile : str
+      name of the output file
+   data : dict
+      the data as returned by read_grib_files
+   layout : str
+      "wgrib2" or "stacked", see above
+   chunks : tuple
+      number of grid points (latitude, longitude) per chunk,
+      e.g., (1, 1) or (4, 4)
+   complevel : int
+      zlib compression level (0-9), 0 disables compression
+   shuffle : bool
+      whether or not to use the shuffle filter
+   """
+   import numpy as np
+   from netCDF4 import Dataset
+
+   if not layout in ["wgrib2", "stacked"]:
+      raise ValueError("layout has to be \"wgrib2\" or \"stacked\"")
+   if not len(chunks) == 2 or min(chunks) < 1:
+      raise ValueError("chunks has to be a tuple with two positive integers")
+   if not complevel in range(10):
+      raise ValueError("complevel has to be within 0-9")
+
+   nt, nj, ni = len(data["time"]), len(data["latitude"]), len(data["longitude"])
+
+   nc = Dataset(ncfile, "w", format = "NETCDF4")
+   try:
+      nc.setncattr("Conventions", "COARDS")
+      nc.setncattr("source", "GFS_combine.py")
+      nc.setncattr("reference_time", data["date"].strftime("%Y-%m-%d %H:%M:%S UTC"))
+
+      nc.createDimension("time",      None)
+      nc.createDimension("latitude",  nj)
+      nc.createDimension("longitude", ni)
+
+      var = nc.createVariable("time", "f8", ("time",))
+      var.units     = "seconds since 1970-01-01 00:00:00.0"
+      var.long_name = "verification time generated by GFS_combine.py"
+
+      var = nc.createVariable("latitude", "f8", ("latitude",))
+      var.units, var.long_name = "degrees_north", "latitude"
+      var[:] = data["latitude"]
+      var = nc.createVariable("longitude", "f8", ("longitude",))
+      var.units, var.long_name = "degrees_east", "longitude"
+      var[:] = data["longitude"]
+
+      # Chunks contain (at least) 32 times such that forecast
+      # steps appended later on are stored in the same chunk.
+      chunks = [max(nt, 32), min(nj, chunks[0]), min(ni, chunks[1])]
+      if layout == "stacked":
+         nc.createDimension("param", None)
+         nc.createVariable("param", str, ("param",)).long_name = "variable name"
+         nc.createVariable("level", str, ("param",)).long_name = "level"
+         var = nc.createVariable("present", "i1", ("param", "time"), fill_value = 0)
+         var.long_name = "1 if the field (param, time) is stored"
+         var = nc.createVariable("data", "f4", ("param", "time", "latitude", "longitude"),
+                                 zlib = complevel > 0, complevel = max(1, complevel),
+                                 shuffle = shuffle, fill_value = np.float32(9.999e20),
+                                 chunksizes = [max(len(data["variables"]), 16)] + chunks)
+         var.long_name = "all variables, see param"
+      nc.setncattr("layout",    layout)
+      nc.setncattr("chunks",    chunks)
+      nc.setncattr("complevel", complevel)
+      nc.setncattr("shuffle",   int(shuffle))
+      _write_netcdf_data(nc, data)
+   finally:
+      nc.close()
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def append_netcdf(ncfile, data):
+   """append_netcdf(ncfile, data)
+
+   Adds new forecast steps and/or variables to an existing
+   NetCDF file (see write_netcdf). New times are appended along the
+   unlimited time dimension; data for times already in the file (e.g.,
+   a new parameter for an existing forecast step) are written into the
+   existing time slices.
+
+   Parameters
+   ----------
+   ncfile : str
+      name of the NetCDF file
+   data : dict
+      the data as returned by read_grib_files
+
+   Returns
+   -------
+   Returns True on success. False if the data cannot be appended (a
+   different grid or model initialization, or new times before the
+   last time in the file); the file is not modified in this case.
+   """
+   import numpy as np
+   from netCDF4 import Dataset
+
+   nc = Dataset(ncfile, "a")
+   try:
+      if not "layout" in nc.ncattrs() or \
+         not nc.getncattr("reference_time") == data["date"].strftime("%Y-%m-%d %H:%M:%S UTC") or \
+         not np.array_equal(nc.variables["latitude"][:], data["latitude"]) or \
+         not np.array_equal(nc.variables["longitude"][:], data["longitude"]):
+         return False
+      times = nc.variables["time"][:]
+      new   = [x for x in _seconds(data["time"]) if not x in times]
+      if len(times) > 0 and len(new) > 0 and min(new) < max(times): return False
+      _write_netcdf_data(nc, data)
+   finally:
+      nc.close()
+   return True
+
+
+def _seconds(times):
+   # Datetime objects to seconds since 1970-01-01 00:00
+   import numpy as np
+   epoch = np.datetime64("1970-01-01T00:00", "s")
+   return [int((np.datetime64(x, "s") - epoch).astype(int)) for x in times]
+
+
+def _write_netcdf_data(nc, data):
+   # Writes the data into an open NetCDF file (see write_netcdf and
+   # append_netcdf); new times are appended.
+   import numpy as np
+   import datetime as dt
+
+   # Index of the times in the file
+   var   = nc.variables["time"]
+   times = list(var[:])
+   tidx  = []
+   for x in _seconds(data["time"]):
+      if not x in times:
+         var[len(times)] = x
+         times.append(x)
+      tidx.append(times.index(x))
+
+   layout = nc.getncattr("layout")
+   chunks = [int(x) for x in nc.getncattr("chunks")]
+   level  = int(nc.getncattr("complevel"))
+   params = list(nc.variables["param"][:]) if layout == "stacked" else None
+   for rec in data["variables"]:
+      if layout == "stacked":
+         if not rec["name"] in params:
+            nc.variables["param"][len(params)] = rec["name"]
+            nc.variables["level"][len(params)] = rec["level"]
+            params.append(rec["name"])
+         p = params.index(rec["name"])
+      elif not rec["name"] in nc.variables:
+         var = nc.createVariable(rec["name"], "f4", ("time", "latitude", "longitude"),
+                                 zlib = level > 0, complevel = max(1, level),
+                                 shuffle = bool(nc.getncattr("shuffle")),
+                                 fill_value = np.float32(9.999e20), chunksizes = chunks)
+         var.short_name = rec["name"]
+         var.long_name  = rec["param"]
+         var.level      = rec["level"]
+         var.steps      = np.array([], dtype = np.int32)
+      if layout == "wgrib2":
+         var = nc.variables[rec["name"]]
+         var.steps = np.union1d(np.atleast_1d(var.steps), rec["steps"]).astype(np.int32)
+
+      # Only the time slices decoded (do not overwrite existing data),
+      # consecutive time slices are written at once.
+      idx = sorted([data["time"].index(data["date"] + dt.timedelta(hours = x)) for x in rec["steps"]])
+      while len(idx) > 0:
+         n = 1
+         while n < len(idx) and idx[n] == idx[0] + n and tidx[idx[n]] == tidx[idx[0]] + n: n += 1
+         k = slice(tidx[idx[0]], tidx[idx[0]] + n)
+         values = np.ma.masked_invalid(rec["data"][idx[0]:idx[0] + n])
+         if layout == "stacked":
+            nc.variables["data"][p, k] = values
+            nc.variables["present"][p, k] = 1
+         else:
+            var[k] = values
+         idx = idx[n:]
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def get_netcdf_steps(ncfile):
+   """get_netcdf_steps(ncfile)
+
+   Parameters
+   ----------
+   ncfile : str
+      name of the NetCDF file
+
+   Returns
+   -------
+   Returns a set of (variable name, forecast step) tuples stored in a
+   NetCDF file created by write_netcdf, None if the file was not created
+   by write_netcdf (e.g., by wgrib2) and cannot be appended.
+   """
+   import numpy as np
+   import datetime as dt
+   from netCDF4 import Dataset
+
+   nc = Dataset(ncfile, "r")
+   try:
+      if not "layout" in nc.ncattrs(): return None
+      res = set()
+      if nc.getncattr("layout") == "stacked":
+         ref   = dt.datetime.strptime(nc.getncattr("reference_time"), "%Y-%m-%d %H:%M:%S UTC")
+         steps = (nc.variables["time"][:] - _seconds([ref])[0]) / 3600.
+         steps = [int(x) if x == int(x) else x for x in steps]
+         for p, i in zip(*np.where(nc.variables["present"][:] == 1)):
+            res.add((nc.variables["param"][p], steps[i]))
+      else:
+         for name, var in nc.variables.items():
+            if not "steps" in var.ncattrs(): continue
+            res.update([(name, int(x)) for x in np.atleast_1d(var.steps)])
+   finally:
+      nc.close()
+   return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def combine_grib_files(grbfiles, ncfile, ncformat = None):
+   """combine_grib_files(grbfiles, ncfile, ncformat = None)
+
+   Combines a set of grib files into one NetCDF file (see
+   read_grib_files and write_netcdf). If GFS_grib2 cannot decode
+   the files (NotImplementedError) wgrib2 is used (see
+   wgrib2_netcdf). The file is written as "<ncfile>.part" and
+   renamed when completed, "ncfile" only exists if complete.
+
+   Parameters
+   ----------
+   grbfiles : list
+      list of grib2 file names
+   ncfile : str
+      name of the output file
+   ncformat : None or dict
+      options for the NetCDF file (layout, chunks, complevel, shuffle;
+      see write_netcdf). Not used if wgrib2 is used.
+   """
+   import os
+
+   tmpfile = "{:s}.part".format(ncfile)
+   try:
+      try:
+         data = read_grib_files(grbfiles)
+      except NotImplementedError as e:
+         print("   [!] {:s}, using wgrib2".format(str(e)))
+         wgrib2_netcdf(grbfiles, tmpfile)
+         data = None
+      else:
+         if data is None:
+            raise Exception("no grib messages found, cannot create {:s}".format(ncfile))
+         write_netcdf(tmpfile, data, **({} if ncformat is None else ncformat))
+   except:
+      if os.path.isfile(tmpfile): os.remove(tmpfile)
+      raise
+   os.rename(tmpfile, ncfile)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def update_netcdf(grbfiles, ncfile, ncformat = None):
+   """update_netcdf(grbfiles, ncfile, ncformat = None)
+
+   Adds the forecast steps and variables not yet stored in an
+   existing NetCDF file (see get_netcdf_steps, append_netcdf). Only the
+   new messages are decoded. The file is copied to "<ncfile>.part",
+   updated, and renamed. If the data cannot be appended (e.g., a missing
+   forecast step arrives after later steps) or the file has not been
+   created by write_netcdf (e.g., by wgrib2, no "layout" attribute) the
+   file is created again from all grib files (see combine_grib_files).
+
+   Parameters
+   ----------
+   grbfiles : list
+      list of grib2 file names
+   ncfile : str
+      name of the NetCDF file
+   ncformat : None or dict
+      options for the NetCDF file if the file has to be created again
+      (see combine_grib_files); new fields are appended using the format
+      of the existing file.
+
+   Returns
+   -------
+   Returns the number of fields (variable, forecast step) added; None if
+   the file has been created again as it was not created by write_netcdf.
+   """
+   import os
+   import shutil
+
+   skip = get_netcdf_steps(ncfile)
+   if skip is None:
+      print("   [!] {:s} not created by GFS_combine.py, create it again".format(ncfile))
+      combine_grib_files(grbfiles, ncfile, ncformat)
+      return None
+   data = read_grib_files(grbfiles, skip)
+   if data is None: return 0
+
+   tmpfile = "{:s}.part".format(ncfile)
+   try:
+      shutil.copyfile(ncfile, tmpfile)
+      appended = append_netcdf(tmpfile, data)
+   except:
+      if os.path.isfile(tmpfile): os.remove(tmpfile)
+      raise
+   if appended:
+      os.rename(tmpfile, ncfile)
+   else:
+      os.remove(tmpfile)
+      combine_grib_files(grbfiles, ncfile, ncformat)
+
+   return sum([len(x["steps"]) for x in data["variables"]])
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def combine_run(directory, ncfile, grbpattern, incremental = False, ncformat = None):
+   """combine_run(directory, ncfile, grbpattern, incremental = False, ncformat = None)
+
+   Combines all grib files of one model run (one directory) into one
+   NetCDF file (see combine_grib_files). If incremental is True and
+   the NetCDF file exists, only new forecast steps and variables are
+   added (see update_netcdf). Used by the main script, runs in a worker
+   process if --jobs is larger than 1.
+
+   Parameters
+   ----------
+   directory : str
+      directory containing the grib files of one model run
+   ncfile : str
+      name of the output file
+   grbpattern : str
+      regular expression to identify the grib files to be considered
+   incremental : bool
+      whether or not to update existing NetCDF files
+   ncformat : None or dict
+      options for the NetCDF file, see combine_grib_files
+
+   Returns
+   -------
+   Returns a dictionary with the name of the output file ("ncfile"),
+   the number of grib files ("files"), the number of fields added if the
+   file has been updated ("added", None if the file has been created or
+   created again, see update_netcdf), the time needed in seconds ("seconds"), and the
+   error message ("error", None if successful).
+   """
+   import os
+   import re
+   import time
+   from glob import glob
+
+   start = time.time()
+   res   = {"ncfile": ncfile, "files": 0, "added": None, "seconds": None, "error": None}
+
+   # Find all files matching our pattern
+   pat = "^" + re.escape(directory) + "/" + grbpattern
+   grbfiles = sorted([x for x in glob(os.path.join(directory, "*")) if re.match(pat, x)])
+   res["files"] = len(grbfiles)
+
+   # Decode the grb2 files and write the netcdf file
+   try:
+      if incremental and os.path.isfile(ncfile):
+         res["added"] = update_netcdf(grbfiles, ncfile, ncformat)
+      else:
+         combine_grib_files(grbfiles, ncfile, ncformat)
+   except Exception as e:
+      res["error"] = str(e)
+   res["seconds"] = time.time() - start
+
+   return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def wgrib2_netcdf(grbfiles, ncfile):
+   """wgrib2_netcdf(grbfiles, ncfile)
+
+   Combines a set of grib files into one NetCDF file using
+   "wgrib2 -netcdf" (the grib files are concatenated into a
+   temporary file first).
+
+   Parameters
+   ----------
+   grbfiles : list
+      list of grib2 file names
+   ncfile : str
+      name of the output file
+   """
+   import shutil
+   import tempfile
+   import subprocess as sub
+   try:
+      from shutil import which # Python 3
+   except ImportError:
+      from distutils.spawn import find_executable as which # Python 2
+
+   # Requires wgrib2, check if executable exists
+   if not which("wgrib2"):
+      raise Exception("wgrib2 cannot be found on this computer. Stop.")
+
+   # Combine files
+   tmp = tempfile.NamedTemporaryFile(prefix = "GFS_combine_")
+   try:
+      for grb in grbfiles:
+         with open(grb, "rb") as gid:
+            shutil.copyfileobj(gid, tmp)
+      tmp.flush()
+   except Exception as e:
+      raise Exception("problems merging the individual grib files! " + str(e))
+         
+   # Convert to netcdf
+   cmd = ["wgrib2", tmp.name, "-netcdf", ncfile]
+   p   = sub.Popen(cmd, stdout = sub.PIPE, stderr = sub.PIPE)
+   out, err = p.communicate()
+   tmp.close() # Destroy temporary file
+   if not p.returncode == 0:
+      print(err)
+      raise Exception("problems converting grib to netcdf")
+
 
-   
 
 if __name__ == "__main__":
 
    import os
    import sys
-   import subprocess as sub
-   import glob
+   import time
+   import re
+   import argparse
 
    os.environ["TZ"] = "UTC"
 
-   # Requires wgrib2, check if executable exists before
-   # doing anything else
-   import distutils.spawn
-   check = distutils.spawn.find_executable("wgrib2")
-   if not check:
-      raise Exception("wgrib2 cannot be found on this computer. Stop.")
+   # Parsing input args
+   parser = argparse.ArgumentParser(description = "Combine the GFS subset files into NetCDF files")
+   parser.add_argument("--jobs", "-j", type = int, default = 1,
+              help = "Number of model runs converted in parallel (worker processes). Default 1.")
+   parser.add_argument("--incremental", "-i", default = False, action = "store_true",
+              help = "Add new forecast steps/parameters to existing NetCDF files " + \
+                     "instead of skipping them.")
+   parser.add_argument("--layout", type = str, default = "wgrib2", choices = ["wgrib2", "stacked"],
+              help = "Layout of the NetCDF files: one variable per parameter (wgrib2, " + \
+                     "default, as used by GFS_interpolate.R) or all parameters in one " + \
+                     "variable (stacked; param, time, latitude, longitude).")
+   parser.add_argument("--chunks", type = str, default = "4x4",
+              help = "Number of grid points (latitude x longitude) per chunk, " + \
+                     "each chunk contains all times. Default 4x4.")
+   parser.add_argument("--complevel", type = int, default = 4,
+              help = "zlib compression level (0-9), 0 disables compression. Default 4.")
+   parser.add_argument("--noshuffle", default = False, action = "store_true",
+              help = "Disables the shuffle filter.")
+   args = vars(parser.parse_args())
+   if args["jobs"] < 1: raise ValueError("--jobs has to be a positive integer")
+   if not re.match("^[0-9]+x[0-9]+$", args["chunks"]):
+      raise ValueError("--chunks has to be of format <lat>x<lon> (e.g., 4x4)")
+   ncformat = {"layout": args["layout"], "complevel": args["complevel"],
+               "chunks": tuple([int(x) for x in args["chunks"].split("x")]),
+               "shuffle": not args["noshuffle"]}
 
    # Directory with the grib files
    gribdir = "data"
@@ -80,11 +668,11 @@ if __name__ == "__main__":
          raise Exception(e)
 
    # Searching for all directories
-   import tempfile
    import datetime as dt
    from glob import glob
    import re
    dirs = glob(os.path.join(gribdir, "*")); dirs.sort()
+   runs = []
    for directory in dirs: #glob(os.path.join(gribdir, "*")):
       if not re.match("^" + gribdir + "/[0-9]{12}$", directory): continue
 
@@ -92,44 +680,47 @@ if __name__ == "__main__":
       date = re.findall("^" + gribdir + "/([0-9]{12})$", directory)
       date = dt.datetime.strptime(date[0], "%Y%m%d%H%M")
 
-      print("* Processing GFS run {:s}".format(date.strftime("%Y-%m-%d %H UTC"))),
       ncfile = get_netcdf_file_name(ncdir, date)
+      if os.path.isfile(ncfile) and not args["incremental"]:
+         print("* GFS run {:s} exists, skip".format(date.strftime("%Y-%m-%d %H UTC")))
+         continue
+      runs.append((date, directory, ncfile))
 
-      if os.path.isfile(ncfile):
-          print("... exists, skip")
-          continue
-      else: print("")
-
-      # What we have to do:
-      # (1) Find all grb2 files matching our pattern
-      # (2) Combine all single grb2 files into one big grb2 file
-      # (3) Convert the combined grb2 file to netcdf
-
-      # (1) Find all files ...
-      grbfiles = []
-      pat = "^" + directory + "/" + grbpattern
-      for file in glob(os.path.join(directory, "*")):
-         if re.match(pat, file): grbfiles.append(file)
-      print("   Found {:d} files matching".format(len(grbfiles)))
-      grbfiles.sort()
-
-      # (2) Combine files
-      tmp = tempfile.NamedTemporaryFile(prefix = "GFS_combine_")
-      try:
-         for grb in grbfiles:
-             with open(grb) as gid:
-                 tmp.write("".join(gid.readlines()))
-         tmp.flush()
-      except Exception as e:
-         raise Exception("problems merging the individual grib files! " + e)
-         
-      # (3) Convert to netcdf
-      cmd = ["wgrib2", tmp.name, "-netcdf", ncfile]
-      p   = sub.Popen(cmd, stdout = sub.PIPE, stderr = sub.PIPE)
-      out, err = p.communicate()
-      if not p.returncode == 0:
-         print(err)
-         raise Exception("problems converting grib to netcdf")
+   # Converting the model runs, sequentially or using --jobs
+   # worker processes (one model run per process).
+   start = time.time()
+   def report(date, res):
+      added = "" if res["added"] is None else "{:d} fields added, ".format(res["added"])
+      print("* GFS run {:s}: {:d} files, {:s}".format(date.strftime("%Y-%m-%d %H UTC"),
+            res["files"], "{:s}{:.1f}s".format(added, res["seconds"]) if res["error"] is None \
+            else "ERROR: {:s}".format(res["error"])))
 
-      tmp.close() # Destroy temporary file
+   if args["jobs"] == 1:
+      results = []
+      for date, directory, ncfile in runs:
+         results.append(combine_run(directory, ncfile, grbpattern, args["incremental"], ncformat))
+         report(date, results[-1])
+   else:
+      from multiprocessing import Pool
+      pool = Pool(args["jobs"])
+      try:
+         jobs    = [pool.apply_async(combine_run, (directory, ncfile, grbpattern,
+                                                  args["incremental"], ncformat)) \
+                    for date, directory, ncfile in runs]
+         results = []
+         for (date, directory, ncfile), job in zip(runs, jobs):
+            results.append(job.get())
+            report(date, results[-1])
+      finally:
+         pool.close()
+         pool.join()
 
+   # Summary
+   failed  = [res for res in results if not res["error"] is None]
+   seconds = [res["seconds"] for res in results if res["error"] is None]
+   print("Converted {:d} of {:d} model runs in {:.1f}s ({:d} jobs){:s}".format(
+         len(seconds), len(results), time.time() - start, args["jobs"],
+         "" if len(seconds) == 0 else ", {:.1f}s per run (mean), {:.1f}s (max)".format(
+         sum(seconds) / len(seconds), max(seconds))))
+   if len(failed) > 0:
+      sys.exit("{:d} model run(s) failed".format(len(failed)))
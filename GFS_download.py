@@ -5,8 +5,8 @@
 # - DATE:        2018-10-11
 # -------------------------------------------------------------------
 # - DESCRIPTION: Quick and dirty py2.7 script to download some data
-#                for delta airlines. Requires wgrib2 for the spatial
-#                subsetting. 
+#                for delta airlines. Spatial subsets are created by
+#                GFS_grib2.py (wgrib2 only needed for unsupported grids). 
 # -------------------------------------------------------------------
 # - EDITORIAL:   2018-10-11, RS: Created file on thinkreto.
 # -------------------------------------------------------------------
@@ -24,8 +24,8 @@ def bar():
 
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
-def get_file_names(config, date, step, filedir):
-    """get_file_names(config, date, step, filedir)
+def get_file_names(config, date, step, filedir, verbose = True):
+    """get_file_names(config, date, step, filedir, verbose = True)
 
     Generates the file names (remote only)
 
@@ -41,6 +41,8 @@ def get_file_names(config, date, step, filedir):
         forecast step (in hours)
     filedir : str
         folder where to store the downloaded files
+    verbose : bool
+        if False nothing is printed.
 
     Returns
     -------
@@ -48,6 +50,7 @@ def get_file_names(config, date, step, filedir):
     and the grib file ("grib") plus a local file name ("local") and the file
     name of the local subset ("subset").
     """
+    import sys
     from os.path import join
     import numpy
     import datetime as dt
@@ -59,12 +62,12 @@ def get_file_names(config, date, step, filedir):
     # If forecast run is not older than 5 days
     today = dt.datetime.today()
     if ((today - date).total_seconds() / 86400) < config.get("rolling_ndays"):
-        print("- Downloading GFS from live/rolling server")
+        if verbose: print("- Downloading GFS from live/rolling server")
         baseurl = date.strftime(config.get("rolling_url"))
         grburl  = date.strftime(config.get("rolling_grb")).replace("<step>", "{:03d}".format(step))
         idxurl  = date.strftime(config.get("rolling_idx")).replace("<step>", "{:03d}".format(step))
     else:
-        print("- Downloading GFS from archive server")
+        if verbose: print("- Downloading GFS from archive server")
         baseurl = date.strftime(config.get("archive_url"))
         grburl  = date.strftime(config.get("archive_grb")).replace("<step>", "{:03d}".format(step))
         idxurl  = date.strftime(config.get("archive_idx")).replace("<step>", "{:03d}".format(step))
@@ -78,7 +81,9 @@ def get_file_names(config, date, step, filedir):
              "local"  : join(filedir, local),
              "subset" : join(filedir, subset)}
     
-    if sys.version_info[0] < 3:
+    if not verbose:
+        pass
+    elif sys.version_info[0] < 3:
         for key,val in files.iteritems(): print("- {:<10s} {:s}".format(key, val))
     else:
         for key,val in files.items(): print("- {:<10s} {:s}".format(key, val))
@@ -148,6 +153,7 @@ class idx_entry(object):
         self._duration_info = None # current value
 
         # Replace brackets
+        import re
         from re import sub
         self._lev = sub("(\(|\)|\[|\]|\{|\})", "", self._lev)
 
@@ -278,8 +284,306 @@ class idx_entry(object):
 
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
-def parse_index_file(idxfile, remote = True):
-    """parse_index_file(idxfile, remote = True)
+class http_error(Exception):
+    def __init__(self, code, url):
+        """http_error(code, url)
+
+        Raised by http_session.request if the server returns an
+        HTTP status code >= 400 (after all retries).
+        """
+        self.code = code
+        self.url  = url
+        Exception.__init__(self, "HTTP Error {:d} for {:s}".format(code, url))
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class http_session(object):
+
+    # Retry on these status codes (temporary server problems)
+    RETRY_STATUS    = [500, 502, 503, 504]
+    REDIRECT_STATUS = [301, 302, 303, 307, 308]
+
+    def __init__(self, timeout = 60, retries = 3, backoff = 1., max_per_host = 2):
+        """http_session(timeout = 60, retries = 3, backoff = 1., max_per_host = 2)
+
+        Small connection-pooled HTTP/HTTPS client. Connections are kept
+        alive and re-used for subsequent requests to the same host such
+        that downloading the index and grib files for all forecast steps
+        only needs a handful of sockets (TCP/TLS handshakes). Thread-safe;
+        one session can be shared by several worker threads.
+
+        Parameters
+        ----------
+        timeout : int or float
+            socket timeout in seconds
+        retries : int
+            number of retries if a request fails (connection errors or
+            server side errors 500/502/503/504)
+        backoff : float
+            exponential backoff, waits backoff * 2^(n-1) seconds
+            before the n'th retry
+        max_per_host : int
+            maximum number of simultaneous connections per host
+
+        Returns
+        -------
+        No return, initializes a new http_session object. Use
+        http_session.request to send a request.
+        """
+        if not isinstance(retries, int) or retries < 0:
+            raise ValueError("retries has to be a non-negative integer (http_session)")
+        if not isinstance(max_per_host, int) or max_per_host < 1:
+            raise ValueError("max_per_host has to be a positive integer (http_session)")
+
+        import threading
+        self._timeout      = timeout
+        self._retries      = retries
+        self._backoff      = float(backoff)
+        self._max_per_host = max_per_host
+        self._idle         = {} # Idle connections (per host)
+        self._slots        = {} # Semaphores (per host)
+        self._lock         = threading.Lock()
+        # Some statistics
+        self.connections   = 0
+        self.requests      = 0
+
+    def __repr__(self):
+        return "http_session: {:d} requests, {:d} connections opened".format(
+               self.requests, self.connections)
+
+    def _slot(self, key):
+        import threading
+        with self._lock:
+            if not key in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self._max_per_host)
+            return self._slots[key]
+
+    def _connect(self, key):
+        # Returns an idle connection to host "key" (if available)
+        # or opens a new one. Second element is True if the
+        # connection is being re-used.
+        with self._lock:
+            if key in self._idle and len(self._idle[key]) > 0:
+                return self._idle[key].pop(), True
+            self.connections += 1
+        try:
+            import httplib as client # Python 2
+        except ImportError:
+            import http.client as client # Python 3
+        scheme, host, port = key
+        if scheme == "https":
+            conn = client.HTTPSConnection(host, port, timeout = self._timeout)
+        else:
+            conn = client.HTTPConnection(host, port, timeout = self._timeout)
+        return conn, False
+
+    def _release(self, key, conn, reuse):
+        # Puts the connection back into the pool (or closes it)
+        # and releases the slot.
+        if reuse:
+            with self._lock:
+                self._idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        self._slot(key).release()
+
+    def request(self, url, headers = None, method = "GET", redirects = 5):
+        """request(url, headers = None, method = "GET", redirects = 5)
+
+        Sends a request. Connection errors and server side errors
+        are retried with exponential backoff, redirects are followed.
+
+        Parameters
+        ----------
+        url : str
+            http or https url
+        headers : None or dict
+            additional request headers
+        method : str
+            request method
+        redirects : int
+            maximum number of redirects to follow
+
+        Returns
+        -------
+        Returns an http_response object. The response has to be closed
+        (http_response.close) to release the connection.
+        Raises an http_error if the server returns a status >= 400.
+        """
+        try:
+            from urlparse import urlparse, urljoin # Python 2
+        except ImportError:
+            from urllib.parse import urlparse, urljoin # Python 3
+        import time
+
+        tmp = urlparse(url)
+        if not tmp.scheme in ["http", "https"]:
+            raise ValueError("unsupported url \"{:s}\" (http_session)".format(url))
+        key  = (tmp.scheme, tmp.hostname,
+                tmp.port if tmp.port else (443 if tmp.scheme == "https" else 80))
+        path = tmp.path if len(tmp.path) > 0 else "/"
+        if len(tmp.query) > 0: path += "?" + tmp.query
+        if headers is None: headers = {}
+
+        attempt = 0
+        while True:
+            self._slot(key).acquire()
+            conn, reused = self._connect(key)
+            try:
+                conn.request(method, path, headers = headers)
+                resp = conn.getresponse()
+            except Exception as e:
+                self._release(key, conn, False)
+                # Keep-alive connection closed by the server: reconnect
+                if reused: continue
+                if attempt >= self._retries:
+                    raise Exception("request failed after {:d} retries: {:s} ({:s})".format(
+                                    attempt, url, str(e)))
+                attempt += 1
+                time.sleep(self._backoff * 2**(attempt - 1))
+                continue
+            with self._lock: self.requests += 1
+            res = http_response(self, key, conn, resp)
+
+            # Temporary server side problem
+            if resp.status in self.RETRY_STATUS and attempt < self._retries:
+                res.close()
+                attempt += 1
+                time.sleep(self._backoff * 2**(attempt - 1))
+                continue
+            # Follow redirects
+            if resp.status in self.REDIRECT_STATUS and redirects > 0:
+                location = resp.getheader("Location")
+                res.close()
+                if location is None: raise http_error(resp.status, url)
+                return self.request(urljoin(url, location), headers, method, redirects - 1)
+            if resp.status >= 400:
+                res.close()
+                raise http_error(resp.status, url)
+            return res
+
+    def close(self):
+        """close()
+
+        Closes all idle connections.
+        """
+        with self._lock:
+            for key,conns in self._idle.items():
+                for conn in conns: conn.close()
+            self._idle = {}
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class http_response(object):
+
+    def __init__(self, session, key, conn, resp):
+        """http_response(session, key, conn, resp)
+
+        Response returned by http_session.request. Provides the
+        methods of the responses returned by urlopen which are used in
+        this script (getcode, headers, read, readline, close). Closing
+        the response hands the connection back to the session. Can be
+        used as context manager (with ... as resp); the connection is
+        also released if reading fails or the object is garbage collected.
+        """
+        self._session = session
+        self._key     = key
+        self._conn    = conn
+        self._resp    = resp
+        self.headers  = dict([(k.lower(), v) for k,v in resp.getheaders()])
+        self.headers  = _headers(self.headers)
+
+    def getcode(self):
+        return self._resp.status
+
+    def read(self, n = None):
+        try:
+            res = self._resp.read() if n is None else self._resp.read(n)
+        except Exception:
+            self.close()
+            raise
+        # End of data (or truncated response): release the connection
+        if len(res) == 0 and not n == 0: self.close()
+        return res
+
+    def readline(self):
+        try:
+            return self._resp.readline()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self._conn is None: return
+        # Drain small leftovers such that the connection can be re-used
+        if not self._resp.isclosed() and self._resp.length is not None \
+           and self._resp.length <= 65536:
+            try:
+                self._resp.read()
+            except Exception:
+                pass
+        conn, self._conn = self._conn, None
+        reuse = self._resp.isclosed() and not self._resp.will_close
+        try:
+            if not reuse: self._resp.close()
+        finally:
+            self._session._release(self._key, conn, reuse)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class _headers(dict):
+    # Case-insensitive access to the response headers
+    def get(self, key, default = None):
+        return dict.get(self, key.lower(), default)
+
+
+# Session shared by all functions in this script if no
+# explicit session is given (see get_session).
+_default_session = None
+
+def get_session():
+    """get_session()
+
+    Returns
+    -------
+    Returns the shared http_session object, created on first call.
+    Can be replaced by the main script (set_session).
+    """
+    global _default_session
+    if _default_session is None: _default_session = http_session()
+    return _default_session
+
+def set_session(session):
+    """set_session(session)
+
+    Replaces the shared http_session object (see get_session).
+    """
+    if not isinstance(session, http_session):
+        raise ValueError("session has to be an http_session object")
+    global _default_session
+    _default_session = session
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def parse_index_file(idxfile, remote = True, session = None, cache = None, revalidate = False,
+                     columnar = False):
+    """parse_index_file(idxfile, remote = True, session = None, cache = None, revalidate = False,
+                     columnar = False)
  
     Downloading and parsing the grib index file.
     Can be used to read local and remote (http/https) index files.
@@ -289,96 +593,407 @@ def parse_index_file(idxfile, remote = True):
     idxfile : str
         url to the index file
     remote : bool
-        if remote = True urllib2 is used to read the file from the
-        web, else expected to be a local file.
+        if remote = True the http_session is used to read the file from
+        the web, else expected to be a local file.
+    session : None or http_session
+        session used for remote files. If None, get_session() is used.
+    cache : None or inventory_cache
+        if set, parsed (remote) index files are stored in the cache and
+        taken from the cache if available. 
+    revalidate : bool
+        only used if cache is set. If False, cached inventories are used
+        without contacting the server. If True, a conditional request
+        (ETag/Last-Modified) is sent and the cached inventory is only
+        used if the file on the server did not change.
+    columnar : bool
+        if True an idx_table is returned instead of a list.
 
     Returns
     -------
-    Returns a list of index entries (entries of class idx_entry).
+    Returns a list of index entries (entries of class idx_entry)
+    or an idx_table object if columnar = True.
     """
 
     if remote:
 
-        if sys.version_info[0] < 3:
-            import urllib2
-            try:
-                req  = urllib2.Request(idxfile)
-                data = urllib2.urlopen(req).read()
-            except Exception as e:
-                print("[!] Problems reading index file\n    {:s}\n    ... return None".format(idxfile))
-                return None
-            # If the file is empty
-            if len("".join(data)) == 0:
-                print("[!] Problems reading index file, was emptu")
-                return None
-        else:
-            from urllib.request import urlopen
-            try:
-                data = urlopen(idxfile).read()
-            except Exception as e:
-                print("[!] Problems reading index file\n    {:s}\n    ... return None".format(idxfile))
-                return None
+        # Cached inventory
+        cached = None if cache is None else cache.get(idxfile)
+        if cached is not None and not revalidate:
+            return _create_idx_entries(cached[2], columnar)
+
+        headers = {}
+        if cached is not None and cached[0] is not None: headers["If-None-Match"]     = cached[0]
+        if cached is not None and cached[1] is not None: headers["If-Modified-Since"] = cached[1]
+
+        if session is None: session = get_session()
+        try:
+            resp = session.request(idxfile, headers)
+        except Exception as e:
+            print("[!] Problems reading index file\n    {:s}\n    ... return None".format(idxfile))
+            return None
+
+        # Not modified
+        if resp.getcode() == 304 and cached is not None:
+            resp.close()
+            return _create_idx_entries(cached[2], columnar)
 
-            data = data.decode("utf-8")
+        # Parsing the lines while they arrive (extracting message starting
+        # byte, variable name, and variable level)
+        try:
+            records = list(_iter_index_records(_iter_lines(resp)))
+        except ValueError:
+            raise
+        except Exception as e:
+            print("[!] Problems reading index file\n    {:s}\n    ... return None".format(idxfile))
+            return None
+        finally:
+            resp.close()
 
     else:
         from os.path import isfile
         if not isfile(idxfile):
             raise Exception("file {:s} does ont exist on disc".format(idxfile))
         with open(idxfile, "r") as fid:
-            data = "".join(fid.readlines())
+            records = list(_iter_index_records(fid))
 
-    if len(data) == 0:  return None
-    else:               data = data.split("\n")
-       
+    if len(records) == 0: return None
+
+    if remote and cache is not None:
+        cache.put(idxfile, resp.headers.get("ETag"), resp.headers.get("Last-Modified"), records)
+
+    return _create_idx_entries(records, columnar)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def iter_index_file(idxfile, remote = True, session = None):
+    """iter_index_file(idxfile, remote = True, session = None)
+
+    Streaming version of parse_index_file (without cache). The index
+    file is parsed line by line while reading (downloading) and the
+    idx_entry objects are returned one by one, as soon as the end byte
+    (start of the next message) is known.
+
+    Parameters
+    ----------
+    idxfile : str
+        url to the index file or name of a local file.
+    remote : bool
+        if remote = True the http_session is used to read the file from
+        the web, else expected to be a local file.
+    session : None or http_session
+        session used for remote files. If None, get_session() is used.
+
+    Returns
+    -------
+    Generator, yields idx_entry objects.
+    """
+    if remote:
+        if session is None: session = get_session()
+        with session.request(idxfile) as resp:
+            for x in _iter_idx_entries(_iter_index_records(_iter_lines(resp))): yield x
+    else:
+        with open(idxfile, "r") as fid:
+            for x in _iter_idx_entries(_iter_index_records(fid)): yield x
+
+
+def _iter_lines(resp):
+    # Reads a http_response line by line
+    while True:
+        line = resp.readline()
+        if len(line) == 0: break
+        yield line
 
-    # List to store the required index message information
-    idx_entries = []
 
-    # Parsing data (extracting message starting byte,
-    # variable name, and variable level)
+# Pattern for the lines of the index files (wgrib2 inventory)
+#                                 byte             param    level    step
+_index_pattern = "^\\d+:(\\d+):d=\\d{10}:([^:?]+):([^:?]*):([0-9.-]+)\\s(days?|hour)\\s([a-z]+\\s)?fcst"
+
+def _iter_index_records(lines):
+    # Parses the lines of an index file (inventory), yields the tuples
+    # used to create the idx_entry objects. Dots are replaced by "-"
+    # (as in the parameter definitions, see read_config).
     import re
-    #                       hour            param     level     step
-    comp = re.compile("^\d+:(\d+):d=\d{10}:([^:.?]+):([^:\\..?]*):([0-9-]+)\s(days?|hour)\s([a-z]+\s)?fcst.*$")
-    byte = 1 # initial byte
-    for line in data:
+    comp = re.compile(_index_pattern)
+    for line in lines:
+        if not isinstance(line, str): line = line.decode("utf-8")
+        line = line.rstrip("\r\n")
         if len(line) == 0: continue
-        mtch = re.findall(comp, line.replace(".", "-"))
+        mtch = comp.match(line)
         if not mtch:
-            raise Exception("whoops, pattern mismatch \"{:s}\"".format(line))
-        # Else crate the idx_entry (object of class idx_entry which takes up
-        # the information from the index file)
-        idx_entries.append(idx_entry(mtch[0]))
-
-    # Now we know where the message start (bytes), but we do not
-    # know where they end. Append this information.
-    for k in range(0, len(idx_entries)):
-        if (k + 1) == len(idx_entries):
-            idx_entries[k].add_end_byte(None)
+            raise ValueError("whoops, pattern mismatch \"{:s}\"".format(line))
+        yield tuple([x.replace(".", "-") for x in mtch.groups("")])
+
+
+def _parse_index_lines(data):
+    # Parses the lines of an index file (inventory), returns a list
+    # of tuples (the information used to create the idx_entry objects).
+    return list(_iter_index_records(data))
+
+
+def _iter_idx_entries(records):
+    # Creates the idx_entry objects from the tuples; the end byte
+    # of an entry is the start of the next one.
+    prev = None
+    for x in records:
+        x = idx_entry(x)
+        if not prev is None:
+            prev.add_end_byte(x.start_byte() - 1)
+            yield prev
+        prev = x
+    if not prev is None:
+        prev.add_end_byte(None)
+        yield prev
+
+
+def _create_idx_entries(records, columnar = False):
+    # Creates the idx_entry objects from the tuples returned
+    # by _parse_index_lines (or an idx_table if columnar = True).
+    if columnar: return idx_table(records)
+    return list(_iter_idx_entries(records))
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class idx_table(object):
+
+    dtype = [("start", "i8"), ("end", "i8"), ("var", "U32"), ("lev", "U96"),
+             ("step", "i4"), ("duration", "i4"), ("info", "U8")]
+
+    def __init__(self, records = None, data = None):
+        """idx_table(records = None, data = None)
+
+        Column-based version of a list of idx_entry objects. All entries
+        are stored in one numpy structured array (columns start, end,
+        var, lev, step, duration, info; end and duration are -1 if not
+        known/not defined) which allows to filter large inventories
+        (e.g., all steps of a run) without creating one object per entry.
+
+        Iterating over the table or indexing with an integer returns
+        idx_entry objects, get_required_bytes, split_grib_file, and
+        param_matcher can be used with idx_table objects.
+
+        Parameters
+        ----------
+        records : None or list
+            list of tuples as returned by _parse_index_lines.
+        data : None or numpy.ndarray
+            structured array (dtype idx_table.dtype), used if records is None.
+        """
+        import numpy as np
+        from re import sub
+
+        if not records is None:
+            data = np.zeros(len(records), dtype = self.dtype)
+            if len(records) > 0:
+                start, var, lev, time, unit, info = zip(*records)
+                data["start"] = np.fromiter(start, dtype = "i8", count = len(records))
+                data["var"]   = var
+                # Levels, forecast steps and periods only take a few distinct
+                # values, decode the unique ones and map them back.
+                ulev, ilev = np.unique(np.asarray(lev, dtype = "U"), return_inverse = True)
+                data["lev"] = np.asarray([sub("(\\(|\\)|\\[|\\]|\\{|\\})", "", x)
+                                          for x in ulev], dtype = "U")[ilev]
+                key = np.char.add(np.char.add(np.asarray(time, dtype = "U"), ":"),
+                                  np.char.add(np.char.add(np.asarray(unit, dtype = "U"), ":"),
+                                              np.asarray(info, dtype = "U")))
+                ukey, ikey = np.unique(key, return_inverse = True)
+                decoded = np.zeros(len(ukey), dtype = [("step", "i4"), ("duration", "i4"), ("info", "U8")])
+                for k,x in enumerate(ukey):
+                    time, unit, stat = x.split(":")
+                    time = time.split("-")
+                    if len(time) == 1:
+                        decoded[k] = (int(time[0]), -1, "")
+                    else:
+                        duration = int(time[1]) - int(time[0])
+                        if unit.startswith("day"): duration *= 24
+                        decoded[k] = (int(time[1]), duration, stat.strip())
+                for col in ["step", "duration", "info"]: data[col] = decoded[col][ikey]
+                # End bytes: start of the next message - 1, unknown for the last one
+                data["end"][:-1] = data["start"][1:] - 1
+                data["end"][-1]  = -1
+        elif data is None:
+            data = np.zeros(0, dtype = self.dtype)
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        x = self.data[i]
+        if x["duration"] < 0:
+            entry = idx_entry((x["start"], x["var"], x["lev"], "{:d}".format(x["step"]), "hour", ""))
         else:
-            idx_entries[k].add_end_byte(idx_entries[k+1].start_byte() - 1)
+            entry = idx_entry((x["start"], x["var"], x["lev"], "{:d}-{:d}".format(
+                               x["step"] - x["duration"], x["step"]), "hour", x["info"]))
+        entry.add_end_byte(None if x["end"] < 0 else int(x["end"]))
+        return entry
 
-    # Go trough the entries to find the messages we request for.
-    #for rec in idx_entries: print(rec)
-    return idx_entries
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
+    def select(self, step = None, var = None, lev = None, duration = None):
+        """select(step = None, var = None, lev = None, duration = None)
+
+        Parameters
+        ----------
+        step, var, lev, duration : None, single value, or list
+            if set, only entries with these forecast steps, parameter names,
+            levels, or durations (-1 for current values) are selected.
+
+        Returns
+        -------
+        Returns a new idx_table with the selected entries.
+        """
+        import numpy as np
+        keep = np.ones(len(self.data), dtype = bool)
+        for key,val in [("step", step), ("var", var), ("lev", lev), ("duration", duration)]:
+            if val is None: continue
+            keep &= np.isin(self.data[key], val if isinstance(val, list) else [val])
+        return idx_table(data = self.data[keep])
+
+    def keys(self):
+        """keys()
+
+        Returns
+        -------
+        Numpy array with the keys of all entries (see idx_entry.key).
+        """
+        import numpy as np
+        d   = self.data
+        dur = np.char.add(np.char.add(d["duration"].astype("U"), "h "), d["info"])
+        dur = np.where(d["duration"] < 0, "cur", dur)
+        return np.char.add(np.char.add(np.char.add(d["var"], ":"), np.char.add(d["lev"], ":")), dur)
+
+    def ranges(self):
+        """ranges()
+
+        Returns
+        -------
+        List with the byte ranges of all entries (see idx_entry.range).
+        """
+        import numpy as np
+        d   = self.data
+        end = np.where(d["end"] < 0, "", d["end"].astype("U"))
+        return np.char.add(np.char.add(d["start"].astype("U"), "-"), end).tolist()
+
+    def __repr__(self):
+        import numpy as np
+        return "idx_table: {:d} entries, steps {:s}".format(len(self),
+               ", ".join(["{:d}".format(x) for x in np.unique(self.data["step"])]))
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class inventory_cache(object):
+
+    def __init__(self, dbfile):
+        """inventory_cache(dbfile)
+
+        Persistent cache for parsed grib inventories (sqlite3). The
+        inventories are stored by url together with the ETag and
+        Last-Modified header of the response they have been parsed from.
+        Reruns (e.g., with another --set) do neither have to download nor
+        to parse the index files again. Thread-safe.
+
+        Parameters
+        ----------
+        dbfile : str
+            name of the sqlite3 database file, created if not existing
+        """
+        if not isinstance(dbfile, str):
+            raise ValueError("dbfile has to be a string (inventory_cache)")
+
+        import sqlite3
+        import threading
+        self._dbfile = dbfile
+        self._lock   = threading.Lock()
+        self.con     = sqlite3.connect(dbfile, check_same_thread = False)
+        self.con.execute("CREATE TABLE IF NOT EXISTS inventory (" + \
+                         "url TEXT PRIMARY KEY, etag TEXT, modified TEXT, " + \
+                         "created INTEGER, records BLOB)")
+        self.con.commit()
+
+    def get(self, url):
+        """get(url)
+
+        Parameters
+        ----------
+        url : str
+            url of the index (or grib) file
+
+        Returns
+        -------
+        None if not in the cache, else a tuple (etag, last modified, records)
+        where records are the tuples used to create the idx_entry objects.
+        """
+        import pickle
+        with self._lock:
+            res = self.con.execute("SELECT etag, modified, records FROM inventory " + \
+                                   "WHERE url = ?", (url,)).fetchone()
+        if res is None: return None
+        return (res[0], res[1], pickle.loads(bytes(res[2])))
+
+    def put(self, url, etag, modified, records):
+        """put(url, etag, modified, records)
+
+        Stores a parsed inventory.
+
+        Parameters
+        ----------
+        url : str
+            url of the index (or grib) file
+        etag : None or str
+            ETag header of the response
+        modified : None or str
+            Last-Modified header of the response
+        records : list
+            list of tuples as returned by _parse_index_lines
+        """
+        import pickle
+        import time
+        try:
+            from sqlite3 import Binary
+        except ImportError:
+            Binary = bytes
+        data = Binary(pickle.dumps([tuple(x) for x in records], 2))
+        with self._lock:
+            self.con.execute("INSERT OR REPLACE INTO inventory VALUES (?, ?, ?, ?, ?)",
+                             (url, etag, modified, int(time.time()), data))
+            self.con.commit()
+
+    def close(self):
+        with self._lock: self.con.close()
 
 
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
-def create_index_file(grbfile):
-    """parse_index_file(grbfile):
+def create_index_file(grbfile, session = None, cache = None, keep = None, columnar = False):
+    """create_index_file(grbfile, session = None, cache = None, keep = None, columnar = False):
  
-    Well, this is not very efficient. If I cannot find the index file
-    on the server (happens every now and then) I am simply downloading
-    the grib2 file if existing, create my own index file, and use
-    this index file. However, at this point I already have a local
-    copy of the grib2 file and I could use this rather than downloading
-    via curl once again. But ... TODO.
+    If I cannot find the index file on the server (happens every now
+    and then) I am simply downloading the grib2 file if existing, create
+    my own index file (scan_grib2, GFS_grib2.py), and use this index file.
+
+    If "keep" is set the downloaded grib2 file is stored as "keep"
+    (else a temporary file is used which is deleted). The required
+    messages can then be taken from the local copy (see extract_range)
+    instead of downloading them once again.
 
     Parameters
     ----------
     grbfile : str
         url of the remote grib2 file.
+    session : None or http_session
+        session used for the download. If None, get_session() is used.
+    cache : None or inventory_cache
+        if set, the inventory is stored in the cache (key: grbfile)
+        and taken from the cache if available. Note that nothing will be
+        downloaded (and "keep" not be created) if the inventory is cached.
+    keep : None or str
+        name of the file where to store the downloaded grib2 file.
+    columnar : bool
+        if True an idx_table is returned instead of a list.
 
     Returns
     -------
@@ -386,50 +1001,174 @@ def create_index_file(grbfile):
     cannot create an index file locally) or what parse_index_file returns.
     """
 
-    # Requires wgrib2: check if existing
-    import distutils.spawn
-    check = distutils.spawn.find_executable("wgrib2")
-    if not check: 
-        print("[!] Creating index file on your own does not work (wgrib2 missing), skip.")
-        return None
-
-    # Import library
-    try:
-        from urllib import urlretrieve # Python 2
-    except ImportError:
-        from urllib.request import urlretrieve # Python 3
+    # Inventory already in the cache?
+    cached = None if cache is None else cache.get(grbfile)
+    if cached is not None: return _create_idx_entries(cached[2], columnar)
 
+    import os
     import tempfile
-    tmp1 = tempfile.NamedTemporaryFile(prefix = "GFS_grib_")
-    tmp2 = tempfile.NamedTemporaryFile(prefix = "GFS_idx_")
+    if keep is None:
+        tmp   = tempfile.NamedTemporaryFile(prefix = "GFS_grib_")
+        local = tmp.name
+    else:
+        tmp   = None
+        local = "{:s}.part".format(keep)
+
+    if session is None: session = get_session()
     try:
-        urlretrieve(grbfile, tmp1.name)
-    except:
+        with session.request(grbfile) as resp:
+            with open(local, "wb") as fid:
+                while True:
+                    chunk = resp.read(1024**2)
+                    if len(chunk) == 0: break
+                    fid.write(chunk)
+    except Exception:
+        if tmp is not None:
+            tmp.close()
+        elif os.path.isfile(local):
+            os.remove(local)
         return None
     
-    import subprocess as sub
-    import os
-    #print(tmp1.name)
-    #print(grbfile)
-    os.system("wgrib2 {:s}".format(tmp1.name))
-    p = sub.Popen(["wgrib2", tmp1.name],
-                  stdout = sub.PIPE, stderr = sub.PIPE)
-    out, err = p.communicate()
-
-    if not p.returncode == 0:
+    # Create the inventory (pure python GRIB2 scanner, see GFS_grib2.py)
+    from GFS_grib2 import scan_grib2
+    try:
+        records = [x.record() for x in scan_grib2(local)]
+    except Exception as e:
+        print("[!] {:s}".format(str(e)))
+        records = None
+
+    if tmp is not None:
+        tmp.close()
+    elif records is not None:
+        os.rename(local, keep)
+    else:
+        os.remove(local)
+
+    if records is None:
         print("[!] Not able to create proper index file in create_index_file, return None")
         return None
+    if len(records) == 0: return None
+    idx = _create_idx_entries(records, columnar)
 
-    with open(tmp2.name, "w") as fid: fid.write(out)
-
-    idx = parse_index_file(tmp2.name, remote = False)
-    tmp1.close()
-    tmp2.close()
+    if cache is not None:
+        cache.put(grbfile, resp.headers.get("ETag"), resp.headers.get("Last-Modified"), records)
       
     # Return list
     return idx
 
 
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class param_matcher(object):
+
+    def __init__(self, params):
+        """param_matcher(params)
+
+        Matches the parameter definitions (regular expressions, see
+        [params] in the config file) against the entries of an inventory.
+        The expressions are compiled once. If the parameter name and level
+        of an expression are plain strings (e.g., "TMP:2 m above ground:cur")
+        only the inventory entries with this name and level are tested,
+        if only the name is a plain string all entries with this name.
+        All other expressions (including expressions without ":") are
+        tested against all entries.
+
+        Parameters
+        ----------
+        params : dict or list
+            dictionary with the local short names and the parameter
+            definitions (read_config.params) or a list of parameter
+            definitions (in this case the definition is used as name).
+        """
+        import re
+        if isinstance(params, str): params = [params]
+        if isinstance(params, dict):
+            params = sorted(params.items())
+        elif isinstance(params, list):
+            params = [(x, x) for x in params]
+        else:
+            raise ValueError("params has to be a dictionary, a list, or a single string")
+
+        special = re.compile("[.^$*+?{}\\[\\]\\\\|()]")
+        self._params = []
+        for name,param in params:
+            if not isinstance(param, str):
+                raise ValueError("parameter definitions have to be strings")
+            parts = param[1:].split(":") if param.startswith("^") else param.split(":")
+            # Name only used if followed by ":" (e.g., "TMP" also matches "TMPX:...")
+            var   = None if len(parts) < 2 or special.search(parts[0]) else parts[0]
+            # Level only used if followed by ":" (re.match matches the beginning)
+            lev   = None if len(parts) < 3 or var is None or special.search(parts[1]) else parts[1]
+            self._params.append((name, param, re.compile(param), var, lev))
+
+    def names(self):
+        """names()
+
+        Returns
+        -------
+        List with the names of the parameters.
+        """
+        return [x[0] for x in self._params]
+
+    def match(self, idx, step = None):
+        """match(idx, step = None)
+
+        Parameters
+        ----------
+        idx : list or idx_table
+            list of idx_entry objects or idx_table (see parse_index_file).
+        step : None or int
+            if set, only entries for this forecast step are considered.
+
+        Returns
+        -------
+        Returns a list of tuples (name, definition, entries) where entries
+        is the list of the matching idx_entry objects (in the order of idx).
+        """
+        # Column-based inventory: vectorized lookup
+        if isinstance(idx, idx_table): return self._match_table(idx, step)
+
+        # One pass trough the inventory: index by name and (name, level)
+        byvar = {}
+        bylev = {}
+        count = 0
+        for x in idx:
+            if not step is None and not x.step() == step: continue
+            byvar.setdefault(x._var, []).append((count, x))
+            bylev.setdefault((x._var, x._lev), []).append((count, x))
+            count += 1
+
+        res = []
+        for name,param,comp,var,lev in self._params:
+            if not lev is None:
+                candidates = bylev.get((var, lev), [])
+            elif not var is None:
+                candidates = byvar.get(var, [])
+            else:
+                candidates = sorted([y for x in byvar.values() for y in x], key = lambda x: x[0])
+            res.append((name, param, [x for k,x in candidates if comp.match(x.key())]))
+
+        return res
+
+    def _match_table(self, idx, step):
+        import numpy as np
+        if not step is None: idx = idx.select(step = step)
+        keys = idx.keys()
+        res  = []
+        for name,param,comp,var,lev in self._params:
+            if not lev is None:
+                candidates = np.flatnonzero((idx.data["var"] == var) & (idx.data["lev"] == lev))
+            elif not var is None:
+                candidates = np.flatnonzero(idx.data["var"] == var)
+            else:
+                candidates = np.arange(len(idx))
+            res.append((name, param, [idx[k] for k in candidates if comp.match(keys[k])]))
+        return res
+
+    def __repr__(self):
+        indexed = len([x for x in self._params if not x[3] is None])
+        return "param_matcher: {:d} parameters ({:d} indexed)".format(len(self._params), indexed)
+
 
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
@@ -445,9 +1184,9 @@ def get_required_bytes(idx, params, step, stopifnot = False):
     ---------
     idx : list
         list of idx_entry objects. The list returned by parse_index_file.
-    params : str or list
+    params : str, list, or param_matcher
         names of the parameters for which the data should be downloaded later on.
-        Can be a single string or a list of strings.
+        Can be a single string, a list of strings, or a param_matcher object.
     step : int
         forecast step
     stopifnot : bool
@@ -459,35 +1198,26 @@ def get_required_bytes(idx, params, step, stopifnot = False):
     Returns a list of bytes (for curl).
     """
 
-    import re
     import numpy
 
     # Crate a list of the string if only one string is given.
     if isinstance(params, str): params = [params]
-    if not isinstance(params, list):
-        raise ValueError("params has to be a single string or a list")
+    if not isinstance(params, list) and not isinstance(params, param_matcher):
+        raise ValueError("params has to be a single string, a list, or a param_matcher")
     if not isinstance(step, int) and not isinstance(step, numpy.int64):
         raise ValueError("step has to be of tyep int")
+    if isinstance(params, list): params = param_matcher(params)
 
     # Go trough the entries to find the messages we request for.
     res     = []
-    found   = []
     missing = []
-    for param in params:
-        count = 0
-        msg_found = None
-        for x in idx:
-            if not x.step() == step: next
-            if re.match(param, x.key()):
-                count = count + 1
-                msg_found = x # Leep this message
-        if count == 1:
-            res.append(msg_found.range())
-            found.append(msg_found.key())
-        elif count > 0:
+    for name,param,entries in params.match(idx, step):
+        if len(entries) == 1:
+            res.append(entries[0].range())
+        elif len(entries) > 1:
             raise Exception("Expression \"{:s}\"".format(param) + \
                             " matches multiple entries in the index file!")
-        else: # count == 0
+        else:
             missing.append(param)
 
     # Missing messages?
@@ -500,49 +1230,683 @@ def get_required_bytes(idx, params, step, stopifnot = False):
 
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
-def download_range(grib, local, range):
+def parse_byte_ranges(range):
+    """parse_byte_ranges(range)
 
-    print("- Downloading data for {:s}".format(local))
-    if sys.version_info[0] < 3:
-        import urllib2
-        try:
-            req = urllib2.Request(grib)
-            req.add_header("Range", "bytes={:s}".format(",".join(range)))
-            resp = urllib2.urlopen(req)
-        except:
-            raise Exception("[!] Problems downloading the data.\n    Return None, trying to continue ...")
-            #return None
-    else:
-        from urllib.request import urlopen
-        try:
-            resp = urlopen(grib)
-        except:
-            raise Exception("[!] Problems downloading the data.\n    Return None, trying to continue ...")
+    Converts the byte ranges as returned by get_required_bytes
+    into integers.
 
-    with open(local, "wb") as fid: fid.write(resp.read())
-    return True
+    Parameters
+    ----------
+    range : list
+        list of strings of the form "<start>-<end>" or "<start>-" (last
+        message in the grib file, up to the end of the file).
+
+    Returns
+    -------
+    List of lists [start, end] sorted by start byte, where end is
+    None for the last message of the file (open ended range).
+    """
+
+    import re
+    res = []
+    for rec in range:
+        mtch = re.match("^([0-9]+)-([0-9]*)$", rec)
+        if not mtch:
+            raise ValueError("misspecified byte range \"{:s}\"".format(rec))
+        end = None if len(mtch.group(2)) == 0 else int(mtch.group(2))
+        if end is not None and end < int(mtch.group(1)):
+            raise ValueError("misspecified byte range \"{:s}\"".format(rec))
+        res.append([int(mtch.group(1)), end])
+    res.sort(key = lambda x: x[0])
+
+    # Only the last message can be open ended
+    for rec in res[:-1]:
+        if rec[1] is None:
+            raise ValueError("only the last byte range can be open ended")
+
+    return res
 
 
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
-class read_config():
+def plan_byte_ranges(pieces, gap = 0, max_ranges = 32):
+    """plan_byte_ranges(pieces, gap = 0, max_ranges = 32)
 
-    def __init__(self, file, paramset = None):
-        """read_config(file)
+    Merges the byte ranges of the messages to be downloaded into
+    fewer, larger ranges. Messages next to each other in the grib file
+    (e.g., TMP/HGT/UGRD/VGRD on 850 mb) are typically contiguous
+    (end byte + 1 == next start byte) and end up in one range. Ranges
+    separated by at most "gap" bytes are merged as well (the bytes in
+    between will be downloaded but not written to the output file).
 
-        Reading the required configuration from the config file.
+    Parameters
+    ----------
+    pieces : list
+        list of [start, end] as returned by parse_byte_ranges
+    gap : int
+        gap tolerance in bytes, non-negative. Two ranges are merged
+        if the number of bytes between them is <= gap.
+    max_ranges : int
+        maximum number of ranges per request. If there are more
+        merged ranges, multiple requests will be sent.
 
-        Parameters
-        ----------
-        file : str
-            name/path of the configuration file
-        paramset : None or str
-            if None the [param] config will be read, else the
-            [param <set>] config is parsed from the config file. Allowes
-            to process different sets of parameters with the same script.
+    Returns
+    -------
+    Returns a list of requests, each request being a list of byte ranges
+    [start, end] (end can be None for the last message in the file).
+    """
 
-        Returns
-        -------
+    if not isinstance(gap, int) or gap < 0:
+        raise ValueError("gap has to be a non-negative integer")
+    if not isinstance(max_ranges, int) or max_ranges < 1:
+        raise ValueError("max_ranges has to be a positive integer")
+
+    merged = []
+    for start, end in sorted(pieces, key = lambda x: x[0]):
+        if len(merged) > 0 and merged[-1][1] is not None and \
+           (start - merged[-1][1] - 1) <= gap:
+            merged[-1][1] = None if end is None else max(end, merged[-1][1])
+        else:
+            merged.append([start, end])
+
+    return [merged[i:(i + max_ranges)] for i in range(0, len(merged), max_ranges)]
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _open_url(url, ranges = None, session = None):
+    # Opens an url (optionally sending a Range header for the
+    # byte ranges [start, end] in ranges) and returns the response.
+    # Does not raise an error if the server ignores the Range header.
+    headers = {}
+    if ranges is not None:
+        headers["Range"] = "bytes={:s}".format(",".join(["{:d}-{:s}".format(x[0],
+                           "" if x[1] is None else "{:d}".format(x[1])) for x in ranges]))
+    if session is None: session = get_session()
+    return session.request(url, headers)
+
+
+def _parse_content_range(x):
+    # Parses "bytes <start>-<end>/<total>", returns [start, end]
+    # or None if the header cannot be interpreted.
+    import re
+    mtch = None if x is None else re.match("^bytes\s+([0-9]+)-([0-9]+)/([0-9]+|\*)$", x.strip())
+    if not mtch: return None
+    return [int(mtch.group(1)), int(mtch.group(2)), \
+            None if mtch.group(3) == "*" else int(mtch.group(3))]
+
+
+class _range_writer(object):
+
+    def __init__(self, file, pieces, chunk_size = 1024**2, progress = None, manifest = None):
+        """_range_writer(file, pieces, chunk_size = 1024**2, progress = None, manifest = None)
+
+        Writes the downloaded messages (byte ranges) into the output
+        file. The data are streamed in chunks of chunk_size bytes, the
+        memory used does not depend on the size of the messages. Each
+        message ends up at its offset in the output file (messages
+        ordered by byte, no bytes in between). Thread-safe.
+
+        If a manifest file name is given, the messages which have been
+        written completely are recorded in the manifest (json) such that
+        an interrupted download can be resumed (see resume).
+
+        Parameters
+        ----------
+        file : str
+            name of the output file (has to exist)
+        pieces : list
+            list of [start, end] as returned by parse_byte_ranges
+        chunk_size : int
+            chunk size in bytes
+        progress : None or function
+            called as progress(bytes_done, bytes_total) after each chunk.
+            bytes_total is None if the size of the last message is not
+            known (open ended range).
+        manifest : None or str
+            name of the manifest file (checkpoints), None to disable.
+        """
+        import threading
+        self.file       = file
+        self.manifest   = manifest
+        self._url       = None
+        self.pieces     = pieces
+        self.chunk_size = chunk_size
+        self.progress   = progress
+        self.done       = [False] * len(pieces)
+        self.offsets    = [0]
+        for rec in pieces[:-1]: self.offsets.append(self.offsets[-1] + rec[1] - rec[0] + 1)
+        self.total      = None if pieces[-1][1] is None else \
+                          self.offsets[-1] + pieces[-1][1] - pieces[-1][0] + 1
+        self.nbytes     = 0
+        self._lock      = threading.Lock()
+
+    def resume(self, url):
+        """resume(url)
+
+        Reads the manifest of a previous (interrupted) download of the
+        same url and the same messages. Messages listed in the manifest
+        are validated (length, "GRIB" at the start and "7777" at the end of
+        the message) and marked as done; they will not be downloaded again.
+        If there is no usable manifest the output file will be truncated.
+
+        Parameters
+        ----------
+        url : str
+            url of the remote grib file, stored in the manifest
+
+        Returns
+        -------
+        Returns the number of messages recovered.
+        """
+        import os
+        import json
+        self._url = url
+        state = None
+        if self.manifest is not None and os.path.isfile(self.manifest) \
+           and os.path.isfile(self.file):
+            try:
+                with open(self.manifest, "r") as fid: state = json.load(fid)
+            except Exception:
+                state = None
+        if state is None or not state.get("url") == url or \
+           not state.get("pieces") == self.pieces:
+            with open(self.file, "wb") as fid: pass
+            self._checkpoint()
+            return 0
+
+        size = os.path.getsize(self.file)
+        with open(self.file, "rb") as fid:
+            for i in range(0, len(self.pieces)):
+                n = state["done"][i]
+                if not n or self.offsets[i] + n > size: continue
+                # Length of closed ranges is known
+                if self.pieces[i][1] is not None and \
+                   not n == self.pieces[i][1] - self.pieces[i][0] + 1: continue
+                fid.seek(self.offsets[i])
+                head = fid.read(4)
+                fid.seek(self.offsets[i] + n - 4)
+                tail = fid.read(4)
+                if head == b"GRIB" and tail == b"7777": self.done[i] = n
+
+        self._checkpoint()
+        return sum([1 for x in self.done if x])
+
+    def _checkpoint(self):
+        # Writes the manifest (atomically)
+        if self.manifest is None: return
+        import os
+        import json
+        tmp = "{:s}.tmp".format(self.manifest)
+        with open(tmp, "w") as fid:
+            json.dump({"url": self._url, "pieces": self.pieces, "done": self.done}, fid)
+        os.rename(tmp, self.manifest)
+
+    def missing(self):
+        """missing()
+
+        Returns
+        -------
+        Returns the list of pieces not yet written.
+        """
+        return [self.pieces[i] for i,x in enumerate(self.done) if not x]
+
+    def _skip(self, stream, n):
+        while n > 0:
+            tmp = stream.read(min(n, self.chunk_size))
+            if len(tmp) == 0:
+                raise Exception("[!] Incomplete response (unexpected end of data)")
+            n -= len(tmp)
+
+    def _copy(self, stream, fid, n):
+        while n > 0:
+            tmp = stream.read(min(n, self.chunk_size))
+            if len(tmp) == 0:
+                raise Exception("[!] Incomplete response (unexpected end of data)")
+            fid.write(tmp)
+            n -= len(tmp)
+            if self.progress is not None:
+                with self._lock:
+                    self.nbytes += len(tmp)
+                    self.progress(self.nbytes, self.total)
+
+    def write_span(self, stream, span):
+        """write_span(stream, span)
+
+        Reads the bytes span[0] to span[1] (inclusive) from stream and
+        writes the pieces fully covered by the span into the output
+        file. Bytes in between are skipped.
+
+        Parameters
+        ----------
+        stream : object
+            object with a read(n) method (e.g., an http_response),
+            positioned at byte span[0]
+        span : list
+            [start, end, total] as returned by _parse_content_range
+        """
+        pos = span[0]
+        with open(self.file, "r+b") as fid:
+            for i in range(0, len(self.pieces)):
+                start, end = self.pieces[i]
+                # Open ended: covered if the span reaches the end of the file
+                if end is None:
+                    if span[2] is None or not span[1] == span[2] - 1: continue
+                    end = span[1]
+                if self.done[i] or start < pos or end > span[1]: continue
+                if start > pos: self._skip(stream, start - pos)
+                fid.seek(self.offsets[i])
+                self._copy(stream, fid, end - start + 1)
+                fid.flush()
+                with self._lock:
+                    self.done[i] = end - start + 1
+                    self._checkpoint()
+                pos = end + 1
+        # Consume the rest of the span
+        if span[1] >= pos: self._skip(stream, span[1] - pos + 1)
+
+
+def _read_multipart_byteranges(resp, boundary, writer):
+    # Parses a multipart/byteranges response body and writes
+    # the parts by calling writer.write_span.
+    boundary = "--{:s}".format(boundary.strip("\""))
+    while True:
+        line = resp.readline()
+        if len(line) == 0: break
+        line = line.decode("ascii", "ignore").strip()
+        if line == "{:s}--".format(boundary): break
+        if not line == boundary: continue
+        # Part header (terminated by an empty line)
+        span = None
+        while True:
+            line = resp.readline().decode("ascii", "ignore").strip()
+            if len(line) == 0: break
+            if line.lower().startswith("content-range:"):
+                span = _parse_content_range(line.split(":", 1)[1])
+        if span is None:
+            raise Exception("[!] Missing or invalid Content-Range in multipart response")
+        writer.write_span(resp, span)
+
+
+def _download_single_range(grib, span, writer, session):
+    # Downloads one (merged) byte range and writes the pieces covered
+    # by the span. Used by download_range if multi-range requests do
+    # not work. Returns False if the server does not support range
+    # requests at all.
+    with _open_url(grib, [span], session) as resp:
+        res = _parse_content_range(resp.headers.get("Content-Range"))
+        if not resp.getcode() == 206 or res is None: return False
+        writer.write_span(resp, res)
+    return True
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def download_range(grib, local, range, gap = 0, max_ranges = 32, jobs = 4, session = None,
+                   chunk_size = 1024**2, progress = None, resume = True):
+    """download_range(grib, local, range, gap = 0, max_ranges = 32, jobs = 4, session = None,
+                   chunk_size = 1024**2, progress = None, resume = True)
+
+    Downloads the required messages (byte ranges) of a remote grib
+    file. The ranges are merged using plan_byte_ranges and requested
+    with HTTP multi-range requests (at most max_ranges ranges per
+    request); the multipart/byteranges responses are reassembled. If the
+    server rejects or ignores the multi-range request, or coalesces the
+    ranges in a way we cannot use, the missing ranges are downloaded with
+    single-range requests in parallel.
+
+    The messages are written to "local" ordered by byte, without any
+    bytes in between; the size of the local file is the sum of the sizes
+    of the requested messages. The data are streamed to a temporary file
+    in chunks and the temporary file is renamed to "local" once the
+    download is complete; an interrupted download never leaves an
+    incomplete "local" file behind.
+
+    If resume is True, the messages already written to the temporary file
+    are recorded in a sidecar manifest ("<local>.part.json"). When the
+    download has been interrupted, the next call validates the messages
+    already on disc and only requests the missing ones.
+
+    Parameters
+    ----------
+    grib : str
+        url of the remote grib file
+    local : str
+        name of the local file
+    range : list
+        list of byte ranges as returned by get_required_bytes
+    gap : int
+        gap tolerance in bytes, see plan_byte_ranges
+    max_ranges : int
+        maximum number of byte ranges per request, see plan_byte_ranges
+    jobs : int
+        number of parallel single-range requests (fallback only)
+    session : None or http_session
+        session used for the download. If None, get_session() is used.
+    chunk_size : int
+        size of the chunks (bytes) written to disc
+    progress : None or function
+        called as progress(bytes_done, bytes_total) after each chunk,
+        bytes_total is None if not known.
+    resume : bool
+        whether or not to resume interrupted downloads (see above).
+
+    Returns
+    -------
+    Returns True on success, raises an Exception else.
+    """
+
+    import os
+
+    print("- Downloading data for {:s}".format(local))
+    if session is None: session = get_session()
+
+    pieces = parse_byte_ranges(range)
+    if len(pieces) == 0:
+        raise ValueError("no byte ranges to download")
+
+    # Temporary output file (same folder, renamed when complete)
+    # and manifest to resume interrupted downloads.
+    tmpfile  = "{:s}.part".format(local)
+    manifest = "{:s}.part.json".format(local) if resume else None
+    writer   = _range_writer(tmpfile, pieces, chunk_size, progress, manifest)
+    recovered = writer.resume(grib)
+    if recovered > 0:
+        print("- Resume download, {:d} of {:d} messages already on disc".format(
+              recovered, len(pieces)))
+
+    # Only request the missing messages
+    plan   = plan_byte_ranges(writer.missing(), gap, max_ranges)
+    print("- {:d} messages, {:d} byte range(s), {:d} request(s)".format(
+          len(writer.missing()), sum([len(x) for x in plan]), len(plan)))
+
+    # Keep temporary file and manifest on errors (resume)
+    _download_pieces(grib, plan, writer, jobs, session)
+
+    # Check size of the local file
+    if not os.path.getsize(tmpfile) == sum(writer.done):
+        os.remove(tmpfile)
+        if manifest is not None: os.remove(manifest)
+        raise Exception("[!] Size of {:s} does not match the requested bytes".format(local))
+    os.rename(tmpfile, local)
+    if manifest is not None: os.remove(manifest)
+
+    return True
+
+
+def _download_pieces(grib, plan, writer, jobs, session):
+    # Downloads the pieces as planned by plan_byte_ranges (see
+    # download_range).
+
+    # Multi-range requests. The responses are always closed (with), such
+    # that the connection slot (http_session) is released on errors.
+    ranges = True
+    for spans in plan:
+        try:
+            resp = _open_url(grib, spans, session)
+        except Exception as e:
+            print("[!] Multi-range request failed ({:s}), try single ranges".format(str(e)))
+            break
+        with resp:
+            ctype = resp.headers.get("Content-Type", "")
+            span  = _parse_content_range(resp.headers.get("Content-Range"))
+            # The server ignored our Range header (200): no single-range
+            # requests, go straight to the full-file fallback.
+            if not resp.getcode() == 206:
+                ranges = False
+                break
+            # Response with one part per range
+            if ctype.startswith("multipart/byteranges"):
+                import re
+                boundary = re.findall("boundary=([^;]+)", ctype)
+                if len(boundary) == 1:
+                    _read_multipart_byteranges(resp, boundary[0], writer)
+            # Server coalesced the ranges (or only one range requested)
+            elif span is not None:
+                writer.write_span(resp, span)
+
+    # Fallback: parallel single-range requests for all (merged) ranges
+    # which contain missing messages.
+    def covers(span, piece):
+        return piece[0] >= span[0] and (span[1] is None or \
+               (piece[1] is not None and piece[1] <= span[1]))
+    missing = []
+    for span in [x for spans in plan for x in spans]:
+        if ranges and any([covers(span, x) for x in writer.missing()]):
+            missing.append(span)
+    if len(missing) > 0:
+        print("- Downloading {:d} byte range(s) separately".format(len(missing)))
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(jobs, len(missing)))
+        try:
+            pool.map(lambda x: _download_single_range(grib, x, writer, session), missing)
+        except Exception as e:
+            raise Exception("[!] Problems downloading the data.\n    {:s}".format(str(e)))
+        finally:
+            pool.close()
+            pool.join()
+
+    # The server does not support range requests at all: stream the full
+    # file and keep the bytes we need.
+    if len(writer.missing()) > 0:
+        print("[!] Server does not support byte ranges, reading the full file")
+        resp   = _open_url(grib, None, session)
+        stream = resp
+        try:
+            size = resp.headers.get("Content-Length")
+            # No Content-Length (e.g., chunked response): read the file up
+            # to EOF into a temporary file first, the size is needed to
+            # find the last (open ended) message.
+            if size is None:
+                import tempfile
+                import shutil
+                stream = tempfile.TemporaryFile()
+                shutil.copyfileobj(resp, stream, writer.chunk_size)
+                size = stream.tell()
+                stream.seek(0)
+            else:
+                size = int(size)
+            if size == 0:
+                raise Exception("empty response")
+            writer.write_span(stream, [0, size - 1, size])
+        except Exception as e:
+            raise Exception("[!] Problems downloading the data.\n    {:s}".format(str(e)))
+        finally:
+            resp.close()
+            if not stream is resp: stream.close()
+        if len(writer.missing()) > 0:
+            raise Exception("[!] Problems downloading the data (not all ranges found).")
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def extract_range(gribfile, local, range, chunk_size = 1024**2):
+    """extract_range(gribfile, local, range, chunk_size = 1024**2)
+
+    Same as download_range but takes the messages from a local copy
+    of the full grib file (see create_index_file).
+
+    Parameters
+    ----------
+    gribfile : str
+        name of the local copy of the full grib file
+    local : str
+        name of the output file
+    range : list
+        list of byte ranges as returned by get_required_bytes
+    chunk_size : int
+        size of the chunks (bytes) written to disc
+
+    Returns
+    -------
+    Returns True on success, raises an Exception else.
+    """
+
+    import os
+    print("- Extracting data from {:s}".format(gribfile))
+
+    pieces = parse_byte_ranges(range)
+    if len(pieces) == 0:
+        raise ValueError("no byte ranges to extract")
+
+    tmpfile = "{:s}.part".format(local)
+    writer  = _range_writer(tmpfile, pieces, chunk_size)
+    writer.resume(gribfile) # Without manifest: creates empty file
+
+    size = os.path.getsize(gribfile)
+    with open(gribfile, "rb") as fid:
+        for start, end in pieces:
+            fid.seek(start)
+            writer.write_span(fid, [start, size - 1 if end is None else end, size])
+
+    if len(writer.missing()) > 0 or not os.path.getsize(tmpfile) == sum(writer.done):
+        os.remove(tmpfile)
+        raise Exception("[!] Problems extracting the messages from {:s}".format(gribfile))
+    os.rename(tmpfile, local)
+
+    return True
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class token_bucket(object):
+
+    def __init__(self, rate, capacity = None):
+        """token_bucket(rate, capacity = None)
+
+        Thread-safe token bucket rate limiter. Tokens are refilled
+        continuously with "rate" tokens per second up to "capacity".
+        Each request consumes one token; if the bucket is empty the
+        caller sleeps until the next token is available.
+
+        Parameters
+        ----------
+        rate : float
+            number of tokens (requests) per second, positive
+        capacity : None or float
+            maximum number of tokens in the bucket (burst size).
+            If None, capacity = max(1, rate).
+        """
+        if not isinstance(rate, (int, float)) or not rate > 0:
+            raise ValueError("rate has to be a positive number (token_bucket)")
+        if capacity is None: capacity = max(1., float(rate))
+        if not capacity >= 1:
+            raise ValueError("capacity has to be >= 1 (token_bucket)")
+
+        import threading
+        import time
+        self._rate     = float(rate)
+        self._capacity = float(capacity)
+        self._tokens   = float(capacity)
+        self._last     = time.time()
+        self._lock     = threading.Lock()
+
+    def acquire(self, tokens = 1):
+        """acquire(tokens = 1)
+
+        Takes "tokens" tokens from the bucket. Blocks until enough
+        tokens are available.
+        """
+        import time
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self._capacity,
+                                   self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class download_limiter(object):
+
+    def __init__(self, max_per_host = 2, rate = 2., burst = None):
+        """download_limiter(max_per_host = 2, rate = 2., burst = None)
+
+        Limits the load we put on the data servers when downloading
+        several forecast steps in parallel. Combines a per-host
+        concurrency limit (number of simultaneous requests to one
+        server) and a global token bucket (requests per second).
+
+        Parameters
+        ----------
+        max_per_host : int
+            maximum number of simultaneous requests per host
+        rate : float
+            maximum number of requests per second (all hosts)
+        burst : None or int
+            burst size of the token bucket, see token_bucket
+
+        Returns
+        -------
+        No return. Calling the object with an url returns a context
+        manager, e.g., "with limiter(url): download(url)".
+        """
+        if not isinstance(max_per_host, int) or max_per_host < 1:
+            raise ValueError("max_per_host has to be a positive integer (download_limiter)")
+
+        import threading
+        self._max_per_host = max_per_host
+        self._bucket       = token_bucket(rate, burst)
+        self._hosts        = {}
+        self._lock         = threading.Lock()
+
+    def _semaphore(self, url):
+        try:
+            from urlparse import urlparse # Python 2
+        except ImportError:
+            from urllib.parse import urlparse # Python 3
+        import threading
+        host = urlparse(url).netloc
+        with self._lock:
+            if not host in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self._max_per_host)
+            return self._hosts[host]
+
+    def __call__(self, url):
+        return _limiter_slot(self._semaphore(url), self._bucket)
+
+
+class _limiter_slot(object):
+    # Context manager returned by download_limiter.__call__
+    def __init__(self, semaphore, bucket):
+        self._semaphore = semaphore
+        self._bucket    = bucket
+    def __enter__(self):
+        self._semaphore.acquire()
+        self._bucket.acquire()
+        return self
+    def __exit__(self, *args):
+        self._semaphore.release()
+        return False
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class read_config():
+
+    def __init__(self, file, paramset = None):
+        """read_config(file)
+
+        Reading the required configuration from the config file.
+
+        Parameters
+        ----------
+        file : str
+            name/path of the configuration file
+        paramset : None or str
+            if None the [param] config will be read, else the
+            [param <set>] config is parsed from the config file. Allowes
+            to process different sets of parameters with the same script.
+
+        Returns
+        -------
         No return, initializes a new class of type mos_config with a set
         of arguments used to download/process the GFS forecasts.
         """
@@ -572,6 +1936,18 @@ class read_config():
             raise ValueError("read_config has no attribute \"{:s}\"".format(key))
         return getattr(self, key)
 
+    def matcher(self):
+        """matcher()
+
+        Returns
+        -------
+        Returns a param_matcher object for the parameters (self.params),
+        created once and reused.
+        """
+        if not hasattr(self, "_matcher") or not self._matcher[0] == self.params:
+            self._matcher = (dict(self.params), param_matcher(self.params))
+        return self._matcher[1]
+
     def __repr__(self):
 
         res = "GFS Configuration:\n"
@@ -703,8 +2079,107 @@ class read_config():
 
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
-def check_files_exist(files, params, subset_files, split_files):
-    """check_files_exist(files, params, subset_files, split_files)
+def get_run_dir(gribdir, date):
+    """get_run_dir(gribdir, date)
+
+    Parameters
+    ----------
+    gribdir : str
+        base directory (read_config.gribdir)
+    date : datetime.datetime
+        defines model initialization date and time
+
+    Returns
+    -------
+    Returns the name of the directory where the files of one model
+    run are stored (<gribdir>/<YYYYmmddHHMM>).
+    """
+    return "{:s}/{:s}".format(gribdir, date.strftime("%Y%m%d%H%M"))
+
+
+def list_files(filedir):
+    """list_files(filedir)
+
+    Returns
+    -------
+    Returns the set of the names of the files in filedir (one directory
+    scan), an empty set if filedir does not exist.
+    """
+    import os
+    if not os.path.isdir(filedir): return set()
+    return set(os.listdir(filedir))
+
+
+def plan_jobs(config, runs, subset_files, split_files, verify = False, jobs = 4):
+    """plan_jobs(config, runs, subset_files, split_files, verify = False, jobs = 4)
+
+    Creates the list of jobs (model run, forecast step) which have
+    to be processed. Steps for which all files are on disc are skipped.
+    If the run has a manifest (see run_manifest) the steps listed in the
+    manifest are complete, else the directory of the run is scanned once
+    and the steps found on disc are added to the manifest.
+
+    Parameters
+    ----------
+    config : read_config object
+        the object returned by "read_config"
+    runs : list
+        list of datetime.datetime objects, model initializations
+    subset_files : bool
+        whether subsetting is enabled, see check_files_exist
+    split_files : bool
+        whether the files are split, see check_files_exist
+    verify : bool
+        if True, the checksums of the files in the manifests are checked
+        (run_manifest.verify); modified files are deleted and the steps
+        with missing or modified files will be processed again.
+    jobs : int
+        number of files checked at the same time if verify is True.
+
+    Returns
+    -------
+    Returns a tuple with the list of (date, step) tuples to be
+    processed and the number of steps skipped.
+    """
+    import os
+    todo    = []
+    skipped = 0
+    for date in runs:
+        filedir  = get_run_dir(config.gribdir, date)
+        manifest = run_manifest(filedir)
+        if verify and manifest.exists():
+            bad = manifest.verify(jobs)
+            # Delete modified files, such that the steps are processed again.
+            for name in bad:
+                print("[!] File {:s} missing or modified".format(os.path.join(filedir, name)))
+                if os.path.isfile(os.path.join(filedir, name)): os.remove(os.path.join(filedir, name))
+        existing = None if manifest.exists() else list_files(filedir)
+        for step in config.steps:
+            files = get_file_names(config, date, step, filedir, verbose = False)
+            if existing is None:
+                done = manifest.has(get_step_files(files, config.params, subset_files,
+                                                   split_files, filedir, date, step))
+            else:
+                done = check_files_exist(files, config.params, subset_files, split_files,
+                                         filedir, date, step, existing)
+                # Files from before the manifest was introduced: add them,
+                # else the step would be processed again next time.
+                if done:
+                    manifest.add(get_step_files(files, config.params, subset_files,
+                                                split_files, filedir, date, step))
+            if done:
+                skipped += 1
+            else:
+                todo.append((date, step))
+    return todo, skipped
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def check_files_exist(files, params, subset_files, split_files, filedir, date, step,
+                      existing = None):
+    """check_files_exist(files, params, subset_files, split_files, filedir, date, step,
+                      existing = None)
 
     This function checks the existance of local files to see whether
     the download has been done already and whether or not all required
@@ -739,107 +2214,589 @@ def check_files_exist(files, params, subset_files, split_files):
         if the "full" grib file is available on disc, else
         we are looping trough the parameters and check if
         all parameters are already on disc.
+    filedir : str
+        folder where the downloaded files are stored
+    date : datetime.datetime
+        defines model initialization date and time
+    step : int
+        forecast step (in hours)
+    existing : None or set
+        if set: names of the files in filedir (see list_files), used
+        instead of checking the files one by one.
 
     Returns
     -------
     """
 
+    import os
+    if existing is None:
+        isfile = os.path.isfile
+    else:
+        isfile = lambda x: os.path.basename(x) in existing
+
     if not isinstance(split_files, bool):
         raise ValueError("split_files has to be boolean")
     if not isinstance(subset_files, bool):
         raise ValueError("subset_files has to be boolean")
 
-    import os
-    # Only check the "full" file
-    if not split_files:
-        # If the subset file does not exist: return False
-        if subset_files:
-            if not os.path.isfile(files["subset"]):   return False
-            else:                                     return True
-        else:
-            if not os.path.isfile(files["local"]):    return False
-            else:                                     return True
-    # Else we have to check all single files
-    else:
-        if sys.version_info[0] < 3:
-            records = params.iteritems()
-        else:
-            records = params.items()
+    # Only the "full" file (if split_files is False) or all
+    # parameter-based files have to exist.
+    for file in get_step_files(files, params, subset_files, split_files, filedir, date, step):
+        if not isfile(file): return False # At least one missing!
 
-        for rec in records:
-            tmp = get_param_file_name(filedir, date, step, rec[0])
-            if subset_files:
-                if not os.path.isfile(tmp["subset"]):
-                    return False # At least one missing!
-            else:
-                if not os.path.isfile(tmp["local"]):
-                    return False # At least one missing!
+    # If we were able to reach this point all files are here,
+    # return True.
+    return True
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def get_step_files(files, params, subset_files, split_files, filedir, date, step):
+    """get_step_files(files, params, subset_files, split_files, filedir, date, step)
+
+    Parameters
+    ----------
+    See check_files_exist.
+
+    Returns
+    -------
+    List with the names of the files created for one forecast step:
+    the "full" (or subset) file if split_files is False, else
+    the parameter-based files.
+    """
+    key = "subset" if subset_files else "local"
+    if not split_files: return [files[key]]
+    return [get_param_file_name(filedir, date, step, x)[key] for x in sorted(params.keys())]
 
-        # If we were able to reach this point all files are here,
-        # return True.
-        return True
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class run_manifest(object):
+
+    FILENAME = "manifest.json"
+
+    def __init__(self, filedir):
+        """run_manifest(filedir)
+
+        Keeps track of the files created for one model run (size and
+        md5 checksum), stored in <filedir>/manifest.json. The file is
+        written (atomically) each time new files are added, such that
+        the completeness of a run can be checked by reading one file.
+
+        Parameters
+        ----------
+        filedir : str
+            directory of the model run (see get_run_dir).
+        """
+        import os
+        import json
+        import threading
+        self.filedir = filedir
+        self.file    = os.path.join(filedir, self.FILENAME)
+        self.files   = {}
+        self._lock   = threading.Lock()
+        if os.path.isfile(self.file):
+            with open(self.file, "r") as fid:
+                self.files = json.load(fid)["files"]
+
+    def exists(self):
+        """exists()
+
+        Returns
+        -------
+        True if the manifest file exists on disc.
+        """
+        import os
+        return os.path.isfile(self.file)
+
+    def has(self, files):
+        """has(files)
+
+        Parameters
+        ----------
+        files : list
+            list of file names
+
+        Returns
+        -------
+        True if all files are listed in the manifest.
+        """
+        import os
+        return all([os.path.basename(x) in self.files for x in files])
+
+    def add(self, files):
+        """add(files)
+
+        Adds the files (size, md5 checksum) and writes the manifest.
+
+        Parameters
+        ----------
+        files : list
+            list of file names (have to be located in filedir).
+        """
+        import os
+        info = dict([(os.path.basename(x), self._info(x)) for x in files])
+        with self._lock:
+            self.files.update(info)
+            self._write()
+
+    def verify(self, jobs = 4):
+        """verify(jobs = 4)
+
+        Re-computes the checksums of all files in the manifest (in
+        parallel). Missing or modified files are removed from the
+        manifest.
+
+        Parameters
+        ----------
+        jobs : int
+            number of files checked at the same time.
+
+        Returns
+        -------
+        Returns the list of names of the missing or modified files.
+        """
+        import os
+        from multiprocessing.pool import ThreadPool
+
+        def check(name):
+            file = os.path.join(self.filedir, name)
+            if not os.path.isfile(file): return name
+            return None if self._info(file) == self.files[name] else name
+
+        pool = ThreadPool(jobs)
+        try:
+            bad = [x for x in pool.map(check, sorted(self.files.keys())) if not x is None]
+        finally:
+            pool.close()
+            pool.join()
+
+        if len(bad) > 0:
+            with self._lock:
+                for name in bad: del self.files[name]
+                self._write()
+        return bad
+
+    def _info(self, file):
+        # Size and md5 checksum of a file
+        import os
+        import hashlib
+        md5 = hashlib.md5()
+        with open(file, "rb") as fid:
+            while True:
+                chunk = fid.read(1024**2)
+                if len(chunk) == 0: break
+                md5.update(chunk)
+        return {"size": os.path.getsize(file), "md5": md5.hexdigest()}
+
+    def _write(self):
+        import os
+        import json
+        tmp = "{:s}.part".format(self.file)
+        with open(tmp, "w") as fid:
+            json.dump({"files": self.files}, fid, indent = 1, sort_keys = True)
+        os.rename(tmp, self.file)
+
+    def __repr__(self):
+        return "run_manifest: {:s} ({:d} files)".format(self.file, len(self.files))
 
 
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
-def split_grib_file(gribfile, filedir, date, step, params, delete = True):
-    """split_grib_file(gribfile, filedir, date, step, params)
+def split_grib_file(gribfile, filedir, date, step, params, subset_files = True, delete = True):
+    """split_grib_file(gribfile, filedir, date, step, params, subset_files = True, delete = True)
 
-    Split grib file into parameter-based grib files.
+    Split grib file into parameter-based grib files. The file is
+    scanned once (GFS_grib2.py) and the byte slices of the messages
+    are written to the files given by get_param_file_name.
 
     Parameter
     ---------
-    TODO
+    gribfile : str
+        the (subsetted) grib file to be split
+    filedir : str
+        folder where to store the parameter-based files
+    date : datetime.datetime
+        defines model initialization date and time
+    step : int
+        forecast step (in hours)
+    params : dict or param_matcher
+        dictionary with the local short names and the GFS parameter
+        specifications (read_config.params) or read_config.matcher()
+    subset_files : bool
+        whether gribfile is a spatial subset or not, decides whether
+        the "subset" or the "local" name of get_param_file_name is used.
+    delete : bool
+        whether gribfile should be deleted after splitting.
     """
-    # Generate index file first
-    import tempfile
-    tmp = tempfile.NamedTemporaryFile(prefix = "GFS_downloader_")
-
-    # Create grib2 inventory of local file
-    cmd = ["wgrib2", gribfile]
-    p = sub.Popen(cmd, stdout = sub.PIPE, stderr = sub.PIPE) 
-    out,err = p.communicate()
-    if not p.returncode == 0:
-        print(err)
-        raise Exception("problems creating the index file with wgrib2!")
-    else:
-        tmp.write(out)
-        tmp.flush()
+    import os
 
-    # Parse new inventory
-    idx = parse_index_file(tmp.name, False)
-    tmp.close()
+    # Create and parse grib2 inventory of local file
+    from GFS_grib2 import scan_grib2
+    messages = scan_grib2(gribfile)
+    idx = idx_table([x.record() for x in messages])
 
-    # Split file into parameter-specific grib files
-    gfs_params = [x.key() for x in idx]
-    if sys.version_info[0] < 3:
-        records = params.iteritems()
-    else:
-        records = params.items()
-    for shortName,param in records:
-        # Initial: not yet found
-        msg_index = []
-        # Find all grib messages matching the current 'param' definition (regex)
-        for msg in range(0, len(idx)):
-            if not idx[msg].step() == step: next
-            if re.match(param, idx[msg].key()): msg_index.append(msg)
+    # Find the messages for the parameter-specific grib files
+    if not isinstance(params, param_matcher): params = param_matcher(params)
+    pos   = dict([(x.offset, k) for k,x in enumerate(messages)])
+    found = []
+    for shortName,param,entries in params.match(idx, step):
         # Check if we found the message once, only once
-        if not len(msg_index):
+        if not len(entries):
             raise Exception("Parameter \"{:s}\" ".format(param) + \
-                            "{:d} times (expected: once) ".format(len(msg_index)) + \
+                            "{:d} times (expected: once) ".format(len(entries)) + \
                             "in the downloaded and subsetted grib file.")
+        found.append((shortName, pos[entries[0].start_byte()]))
+
+    # GRIB2 messages are self-contained: write the bytes of the
+    # message straight into the parameter-specific file.
+    import mmap
+    with open(gribfile, "rb") as fid:
+        buf = mmap.mmap(fid.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            for shortName,msg in found:
+                outfile = get_param_file_name(filedir, date, step, shortName)
+                outfile = outfile["subset"] if subset_files else outfile["local"]
+                start   = messages[msg].offset
+                with open("{:s}.part".format(outfile), "wb") as oid:
+                    oid.write(buf[start:(start + messages[msg].length)])
+                os.rename("{:s}.part".format(outfile), outfile)
+        finally:
+            buf.close()
+
+    if delete: os.remove(gribfile)
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def download_step(config, date, step, filedir, subset, split_files, limiter,
+                  gap = 0, max_ranges = 32, cache = None, revalidate = False):
+    """download_step(config, date, step, filedir, subset, split_files, limiter,
+                  gap = 0, max_ranges = 32, cache = None, revalidate = False)
+
+    First part of process_step: fetch the index file, identify the
+    required messages and download them.
+
+    Parameters
+    ----------
+    config : read_config object
+        the object returned by "read_config"
+    date : datetime.datetime
+        defines model initialization date and time
+    step : int
+        forecast step (in hours)
+    filedir : str
+        folder where to store the downloaded files
+    subset : None or dict
+        None or a dict with N/S/E/W in degrees
+    split_files : bool
+        whether or not to split the files into parameter-based files
+    limiter : download_limiter object
+        limits concurrent requests per host and the request rate
+    gap : int
+        gap tolerance when merging byte ranges, see plan_byte_ranges
+    max_ranges : int
+        maximum number of byte ranges per request, see plan_byte_ranges
+    cache : None or inventory_cache
+        cache for the parsed inventories, see parse_index_file
+    revalidate : bool
+        revalidate cached inventories, see parse_index_file
+
+    Returns
+    -------
+    Returns the file names (see get_file_names) if the data have been
+    downloaded, None if the step has been skipped (forecast or index
+    file not available, or no required fields found). Does not check
+    whether the files are already on disc (see plan_jobs).
+    """
+    import os
+    print("Processing +{:03d}h forecast".format(step))
+
+    # Generate remote file URL's. The steps with all files on disc
+    # have already been skipped (see plan_jobs).
+    files = get_file_names(config, date, step, filedir)
+
+    # Read index file (once per forecast step as the file changes
+    # with forecast step).
+    with limiter(files["idx"]):
+        idx = parse_index_file(files["idx"], cache = cache, revalidate = revalidate, columnar = True)
+
+    # If there is no index file: download the full grib file, create
+    # the index, and keep the grib file (extract the messages later on).
+    fullfile = "{:s}.complete".format(files["local"])
+    if idx is None:
+        print("Create local index file, as index file does not exist!")
+        with limiter(files["grib"]):
+            idx = create_index_file(files["grib"], cache = cache, keep = fullfile, columnar = True)
+
+    # File is empty?
+    if idx is None:
+        print("Not able to download/parse the index file. Possible reason:")
+        print("problems with internet/server or the forecast is not available.")
+        print("Continue and skip this one ...")
+        return None
 
-        # Write this specific message into a new file
-        outfile = get_param_file_name(filedir, date, step, shortName)
-        cmd = ["wgrib2", files["local"] if subset is None else files["subset"],
-                "-d", "{:d}".format(1 + msg_index[0]), "-grib",
-                outfile["local"] if subset is None else outfile["subset"]]
-        p = sub.Popen(cmd, stdout = sub.PIPE, stderr = sub.PIPE)
-        out, err = p.communicate()
-        if not p.returncode == 0:
-            raise Exception(err)
+    # Read/parse index file (if possible) and identify the
+    # required sections (byte-sections) for curl download.
+    required = get_required_bytes(idx, config.matcher(), step, True)
+
+    # If no messages found: continue
+    if required is None or len(required) == 0:
+        print("Could not find any required fields, skip ...")
+        return None
+
+    # Downloading the data (or take them from the full grib file
+    # downloaded by create_index_file).
+    if os.path.isfile(fullfile):
+        extract_range(fullfile, files["local"], required)
+        os.remove(fullfile)
+    else:
+        with limiter(files["grib"]):
+            download_range(files["grib"], files["local"], required, gap, max_ranges)
+
+    return files
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def postprocess_step(config, date, step, filedir, subset, split_files, files, pool = None):
+    """postprocess_step(config, date, step, filedir, subset, split_files, files, pool = None)
+
+    Second part of process_step: subset the downloaded grib file
+    and split it into parameter-based files.
+
+    Parameters
+    ----------
+    config : read_config object
+        the object returned by "read_config"
+    date : datetime.datetime
+        defines model initialization date and time
+    step : int
+        forecast step (in hours)
+    filedir : str
+        folder where to store the downloaded files
+    subset : None or dict
+        None or a dict with N/S/E/W in degrees
+    split_files : bool
+        whether or not to split the files into parameter-based files
+    files : dict
+        file names, as returned by download_step
+    pool : None or multiprocessing.Pool
+        if set, the spatial subset is created by one of the worker
+        processes of the pool (subset_grib2).
+
+    Returns
+    -------
+    Returns True.
+    """
+    import os
+    import subprocess as sub
+    try:
+        from shutil import which # Python 3
+    except ImportError:
+        from distutils.spawn import find_executable as which # Python 2
+
+    # Spatial subset (GFS_grib2.subset_grib2, in a worker process if
+    # a pool is given). If the grib file contains grids or packings
+    # subset_grib2 does not support, wgrib2 (-small_grib) is used if
+    # available.
+    if not subset is None:
+        from GFS_grib2 import subset_grib2
+        try:
+            print("- Subsetting {:s}".format(files["local"]))
+            if pool is None:
+                subset_grib2(files["local"], files["subset"], subset)
+            else:
+                pool.apply(subset_grib2, (files["local"], files["subset"], subset))
+            native = True
+        except NotImplementedError as e:
+            print("[!] Cannot subset in-process ({:s}), try wgrib2".format(str(e)))
+            native = False
+
+        check = which("wgrib2")
+        if not native and check is None:
+            raise Exception("Problem with subset (wgrib2 missing), do not delete global grib2 file.")
+        elif not native:
+            WE  = "{:.2f}:{:.2f}".format(subset["W"], subset["E"])
+            SN  = "{:.2f}:{:.2f}".format(subset["S"], subset["N"])
+            cmd = ["wgrib2", "-g2clib", "0", files["local"], "-small_grib", WE, SN, files["subset"]] 
+            print("- Subsetting: {:s}".format(" ".join(cmd)))
+            p = sub.Popen(cmd, stdout = sub.PIPE, stderr = sub.PIPE) 
+            out,err = p.communicate()
+            if not p.returncode == 0:
+                raise Exception("Problem with subset, do not delete global grib2 file.")
+
+        print("- Subset created, delete global file")
+        os.remove(files["local"])
+
+    # Split file
+    if split_files:
+        subsetted = not subset is None and os.path.isfile(files["subset"])
+        split_grib_file(files["subset"] if subsetted else files["local"],
+                        filedir, date, step, config.matcher(), subsetted)
+
+    return True
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def process_step(config, date, step, filedir, subset, split_files, limiter,
+                 gap = 0, max_ranges = 32, cache = None, revalidate = False, pool = None):
+    """process_step(config, date, step, filedir, subset, split_files, limiter,
+                 gap = 0, max_ranges = 32, cache = None, revalidate = False, pool = None)
+
+    Downloads and processes one forecast step: fetch the index file,
+    identify the required messages, download them, subset the grib
+    file and split it into parameter-based files (download_step
+    followed by postprocess_step).
+
+    Parameters
+    ----------
+    See download_step and postprocess_step.
+
+    Returns
+    -------
+    Returns True if the data have been downloaded and processed,
+    False if the step has been skipped.
+    """
+    files = download_step(config, date, step, filedir, subset, split_files, limiter,
+                          gap, max_ranges, cache, revalidate)
+    if files is None: return False
+    return postprocess_step(config, date, step, filedir, subset, split_files, files, pool)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class step_pipeline(object):
+
+    def __init__(self, download, process, download_jobs = 1, process_jobs = 1, max_pending = 2,
+                 keep_going = False):
+        """step_pipeline(download, process, download_jobs = 1, process_jobs = 1, max_pending = 2,
+                 keep_going = False)
+
+        Runs jobs (forecast steps) trough two stages: the downloads, and
+        the processing of the downloaded files (subset, split). Both
+        stages run at the same time, such that step N+1 can be
+        downloaded while step N is processed. The downloaded files are
+        handed over in a queue. A download is only started if less than
+        max_pending steps are being downloaded or waiting/being processed
+        (limits the number of global grib files on disc).
+
+        Parameters
+        ----------
+        download : function
+            called as download(job), returns None if the job was
+            skipped, else an object which is passed to process.
+        process : function
+            called as process(job, x), x is what download returned.
+        download_jobs : int
+            number of threads running downloads.
+        process_jobs : int
+            number of threads processing the downloaded files.
+        max_pending : int
+            maximum number of steps downloaded or processed at the same
+            time (should be at least download_jobs + process_jobs).
+        keep_going : bool
+            if False the first exception raised by download or process
+            stops the pipeline and is raised by run. If True the jobs
+            which failed are recorded (see failed) and all other jobs
+            are processed.
+        """
+        for key,val in [("download_jobs", download_jobs), ("process_jobs", process_jobs),
+                        ("max_pending", max_pending)]:
+            if not isinstance(val, int) or val < 1:
+                raise ValueError("{:s} has to be a positive integer".format(key))
+        self.download      = download
+        self.process       = process
+        self.download_jobs = download_jobs
+        self.process_jobs  = process_jobs
+        self.max_pending   = max_pending
+        self.keep_going    = keep_going
+        self.failed        = {}
+
+    def run(self, steps):
+        """run(steps)
+
+        Parameters
+        ----------
+        steps : list
+            list of jobs (e.g., forecast steps or (date, step) tuples)
+
+        Returns
+        -------
+        List with the results for all jobs (in the order of steps):
+        False if the job was skipped, None if the job failed (keep_going),
+        else what process returned. Raises the first exception raised by
+        download or process unless keep_going is True; in this case the
+        exceptions are stored in the dictionary "failed" (job: exception).
+        """
+        import sys
+        import time
+        import threading
+        try:
+            import Queue as queue
+        except ImportError:
+            import queue
+
+        todo    = queue.Queue()
+        for step in steps: todo.put(step)
+        ready   = queue.Queue()
+        slots   = threading.Semaphore(self.max_pending)
+        results = {}
+        errors  = []
+        self.failed = {}
+
+        def failed(step):
+            # Stop the pipeline, or record the error and continue
+            if not self.keep_going:
+                errors.append(sys.exc_info())
+                return
+            self.failed[step] = sys.exc_info()[1]
+            results[step]     = None
+
+        def downloader():
+            while not errors:
+                # Wait for a free slot (backpressure)
+                if not slots.acquire(False):
+                    time.sleep(.1)
+                    continue
+                try:
+                    step = todo.get_nowait()
+                except queue.Empty:
+                    slots.release()
+                    return
+                try:
+                    x = self.download(step)
+                except Exception:
+                    failed(step)
+                    slots.release()
+                    continue
+                if x is None:
+                    results[step] = False
+                    slots.release()
+                else:
+                    ready.put((step, x))
+
+        def processor():
+            while True:
+                item = ready.get()
+                if item is None: return
+                try:
+                    if not errors: results[item[0]] = self.process(*item)
+                except Exception:
+                    failed(item[0])
+                finally:
+                    slots.release()
+
+        downloaders = [threading.Thread(target = downloader) for i in range(self.download_jobs)]
+        processors  = [threading.Thread(target = processor) for i in range(self.process_jobs)]
+        for t in downloaders + processors: t.start()
+        for t in downloaders: t.join()
+        for t in processors: ready.put(None)
+        for t in processors: t.join()
+
+        if errors: raise errors[0][1]
+        return [results[step] for step in steps]
 
-    os.remove(gribfile)
 
 # -------------------------------------------------------------------
 # Main script
@@ -848,13 +2805,39 @@ if __name__ == "__main__":
 
     # Config
     outdir = "data"
-    # Subset (requires wgrib2), can also be None.
-    # Else a dict with N/S/E/W in degrees (0-360!)
+    # Subset, can also be None.
+    # Else a dict with N/S/E/W in degrees
     subset = {"W": 5, "E": 18, "S": 45, "N": 55}
 
-    # Time to sleep between two requests
-    import time
-    sleeping_time = 2;
+    # Limits for the requests sent to the servers. Instead of sleeping
+    # between two requests a token bucket limits the number of requests
+    # per second; in addition, max_per_host limits the number of
+    # simultaneous requests to one server (relevant for --jobs > 1).
+    max_rate     = 1.
+    max_per_host = 2
+
+    # Byte ranges separated by less than range_gap bytes are merged
+    # and downloaded in one piece (the bytes in between are discarded),
+    # max_ranges is the maximum number of byte ranges per request.
+    range_gap    = 256 * 1024
+    max_ranges   = 32
+
+    # Settings for the (shared) HTTP session. Connections are kept
+    # alive and re-used; failed requests are retried with exponential
+    # backoff (backoff, 2 * backoff, 4 * backoff, ... seconds).
+    http_timeout = 60
+    http_retries = 3
+    http_backoff = 2.
+
+    # Parsed inventories are cached in <gribdir>/inventory_cache.sqlite3.
+    # If inventory_revalidate is True the server is asked whether
+    # the index file changed (ETag/Last-Modified) before using the cache.
+    inventory_revalidate = False
+
+    # Maximum number of (global) grib files downloaded or waiting to
+    # be subsetted/split; limits the disc space needed. At least
+    # --jobs + --procs, see step_pipeline.
+    max_pending  = 4
 
     # Split files into parameter-based files?
     split_files = True
@@ -867,41 +2850,85 @@ if __name__ == "__main__":
     import argparse, sys
     import datetime as dt
     import numpy as np
-    import distutils.spawn
-    import subprocess as sub
 
     # Parsing input args
     parser = argparse.ArgumentParser(description="Download some GEFS data")
     parser.add_argument("--date","-d", type = str,
                help = "Model initialization date. Format has to be YYYY-mm-dd!" + \
                       " Date has to be 2016-12-01 and after. No data before this point.")
+    parser.add_argument("--dates", type = str, default = None,
+               help = "File with model initialization dates (YYYY-mm-dd, one per line, " + \
+                      "e.g., dates.list). Can be combined with -d and --start/--end.")
+    parser.add_argument("--start", type = str, default = None,
+               help = "First date (YYYY-mm-dd) of a range of dates, requires --end.")
+    parser.add_argument("--end", type = str, default = None,
+               help = "Last date (YYYY-mm-dd) of a range of dates, requires --start.")
     parser.add_argument("--set","-s", type = str, default = None,
                help = "Which set of parameters should be downloaded? Default is None, " + \
                       "reading [param] config. However, this allows you to set up multiple " + \
                       "sets of parameters in the config file if needed.")
-    parser.add_argument("--runhour","-r", type = int,
-               help = "Model initialization hour, 0/6/12/18, integer.")
+    parser.add_argument("--runhour","-r", type = str,
+               help = "Model initialization hour, 0/6/12/18, integer. Can also " + \
+                      "be a comma separated list (e.g., 0,12).")
     parser.add_argument("--devel", default = False, action = "store_true",
                help = "Used for development. If set, the script reads config_devel.conf" + \
                       " instead of config.conf.")
+    parser.add_argument("--jobs","-j", type = int, default = 1,
+               help = "Number of forecast steps downloaded in parallel. Default 1.")
+    parser.add_argument("--verify", default = False, action = "store_true",
+               help = "Check the checksums of the files listed in the manifests " + \
+                      "of the model runs; missing or modified files are downloaded again.")
+    parser.add_argument("--procs","-p", type = int, default = 1,
+               help = "Number of downloaded forecast steps processed (subset, split) " + \
+                      "in parallel, using worker processes for the subsets. Default 1.")
     args = vars(parser.parse_args())
 
 
     # Checking args
-    if args["runhour"] is None or args["date"] is None:
+    if args["runhour"] is None or (args["date"] is None and args["dates"] is None \
+       and args["start"] is None):
         parser.print_usage(); sys.exit(9)
-    if not re.match("^[0-9]{4}-[0-9]{2}-[0-9]{2}$", args["date"]):
-        parser.print_usage()
-        raise ValueError("wrong format for input -d/--date")
-    if not args["runhour"] in [0, 6, 12, 18]:
+    if not re.match("^[0-9]{1,2}(,[0-9]{1,2})*$", args["runhour"]) or \
+       not all([int(x) in [0, 6, 12, 18] for x in args["runhour"].split(",")]):
         parser.print_usage()
         raise ValueError("wrong input for -r/--runhour, has to be 0/6/12/18")
-
-    # Crate date arg
-    date   = dt.datetime.strptime("{:s} {:02d}:00".format(args["date"], args["runhour"]),
-                                  "%Y-%m-%d %H:%M")
+    if (args["start"] is None) != (args["end"] is None):
+        parser.print_usage()
+        raise ValueError("--start and --end have to be used together")
+    if args["jobs"] < 1:
+        parser.print_usage()
+        raise ValueError("wrong input for -j/--jobs, has to be a positive integer")
+    if args["procs"] < 1:
+        parser.print_usage()
+        raise ValueError("wrong input for -p/--procs, has to be a positive integer")
+
+    # Dates to be processed
+    dates = [] if args["date"] is None else [args["date"]]
+    if not args["dates"] is None:
+        if not os.path.isfile(args["dates"]):
+            raise ValueError("file \"{:s}\" (--dates) does not exist".format(args["dates"]))
+        with open(args["dates"], "r") as fid:
+            for line in fid:
+                line = line.strip()
+                if len(line) == 0 or line.startswith("#"): continue
+                dates.append(line)
+    for date in [x for x in [args["start"], args["end"]] if not x is None] + dates:
+        if not re.match("^[0-9]{4}-[0-9]{2}-[0-9]{2}$", date):
+            parser.print_usage()
+            raise ValueError("wrong date format \"{:s}\", has to be YYYY-mm-dd".format(date))
+    dates = [dt.datetime.strptime(x, "%Y-%m-%d") for x in dates]
+    if not args["start"] is None:
+        start = dt.datetime.strptime(args["start"], "%Y-%m-%d")
+        end   = dt.datetime.strptime(args["end"], "%Y-%m-%d")
+        dates += [start + dt.timedelta(days = x) for x in range((end - start).days + 1)]
+
+    # Crate list of model runs (initialization date and time)
+    runs = [x + dt.timedelta(hours = int(h)) for x in dates for h in args["runhour"].split(",")]
+    runs = sorted(set(runs))
+    if len(runs) == 0:
+        raise ValueError("no model runs to process, check -d/--dates/--start/--end")
     # Too old?
-    if date < dt.datetime(2016, 12, 1, 0, 0):
+    if runs[0] < dt.datetime(2016, 12, 1, 0, 0):
         parser.print_usage()
         raise ValueError("Sorry, no data before 2016-12-01")
 
@@ -915,114 +2942,92 @@ if __name__ == "__main__":
 
     bar(); print(config); bar()
 
-    # Specify and create output directory if necessary
-    filedir = "{:s}/{:s}".format(config.gribdir, date.strftime("%Y%m%d%H%M"))
-    if not os.path.isdir(filedir):
+    if not os.path.isdir(config.gribdir):
         try:
-            os.makedirs(filedir)
+            os.makedirs(config.gribdir)
         except:
-            raise Exception("Cannot create directory {:s}!".format(filedir))
-
-
-    # Looping over the different members first
-    # Looping over forecast lead times
-    for step in config.steps:
-        print("Processing +{:03d}h forecast".format(step))
-
-        # Generate remote file URL's
-        files = get_file_names(config, date, step, filedir)
-
-        # Check if all files exist. If so, we can skip this download.
-        file_check = check_files_exist(files, config.params, not subset is None, split_files)
-        if file_check: 
-            print("All files on disc, continue ...")
-            continue
-
-        # Read index file (once per forecast step as the file changes
-        # with forecast step).
-        idx = parse_index_file(files["idx"])
-        if idx is None:
-            print("Create local index file, as index file does not exist!")
-            idx = create_index_file(files["grib"])
-
-        # File is empty?
-        if idx is None:
-            print("Not able to download/parse the index file. Possible reason:")
-            print("problems with internet/server or the forecast is not available.")
-            print("Continue and skip this one ...")
-            continue
-
-        # List of the GFS parameter names, used to check what
-        # to download based on the inventory or index file.
-        if sys.version_info[0] < 3:
-            gfs_params = [x[1] for x in config.params.iteritems()]
-        else:
-            gfs_params = [x[1] for x in config.params.items()]
-
-        # Read/parse index file (if possible) and identify the
-        # required sections (byte-sections) for curl download.
-        required = get_required_bytes(idx, gfs_params, step, True)
-
-        # If no messages found: continue
-        if required is None:
-            print("Could not find any required fields, skip ...")
-            continue
-        if len(required) == 0:
-            print("Could not find any required fields, skip ...")
-            continue
-
-        # If wgrib2 exists: used to subset the grib file (-small_grib) and
-        # to create the index file is split_files is set to True.
-        check = distutils.spawn.find_executable("wgrib2")
-
-        # Downloading the data
-        download_range(files["grib"], files["local"], required)
-
-        if not check is None and not subset is None:
-            WE  = "{:.2f}:{:.2f}".format(subset["W"], subset["E"])
-            SN  = "{:.2f}:{:.2f}".format(subset["S"], subset["N"])
-            cmd = ["wgrib2", "-g2clib", "0", files["local"], "-small_grib", WE, SN, files["subset"]] 
-            print("- Subsetting: {:s}".format(" ".join(cmd)))
-            p = sub.Popen(cmd, stdout = sub.PIPE, stderr = sub.PIPE) 
-            out,err = p.communicate()
-
-            if p.returncode == 0:
-                print("- Subset created, delete global file")
-                os.remove(files["local"])
-            else:
-                raise Exception("Problem with subset, do not delete global grib2 file.")
-
-        # Split file
-        if not check is None and split_files:
-            split_grib_file(files["local"] if subset is None else files["subset"],
-                            filedir, date, step, config.params)
-
-        # Else post-processing the data
+            raise Exception("Cannot create directory {:s}!".format(config.gribdir))
+
+    # Jobs (model run, forecast step) to be processed; the steps
+    # with all files on disc are skipped.
+    jobs, skipped = plan_jobs(config, runs, not subset is None, split_files,
+                              args["verify"], 4 * args["procs"])
+    print("{:d} model run(s), {:d} forecast steps to process, {:d} on disc.".format(
+          len(runs), len(jobs), skipped))
+    bar()
+
+    # Limits the number of (parallel) requests
+    limiter = download_limiter(max_per_host, max_rate, burst = args["jobs"])
+
+    # Shared HTTP session, used for all index and data requests
+    set_session(http_session(http_timeout, http_retries, http_backoff, max_per_host))
+
+    # Cache for the parsed inventories
+    cache = inventory_cache(os.path.join(config.gribdir, "inventory_cache.sqlite3"))
+
+    # Manifests of the model runs (files created), see run_manifest.
+    import threading
+    manifests = {}
+    lock      = threading.Lock()
+
+    def completed(job, files):
+        date, step = job
+        filedir = get_run_dir(config.gribdir, date)
+        with lock:
+            if not date in manifests: manifests[date] = run_manifest(filedir)
+        manifests[date].add(get_step_files(files, config.params, not subset is None,
+                                           split_files, filedir, date, step))
         bar()
 
-        print("Sleeping {:d} seconds ...".format(sleeping_time))
-        time.sleep(sleeping_time)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    # Looping over all jobs (model run, forecast step). The steps are
+    # downloaded by --jobs threads and processed by --procs threads at the
+    # same time (pipeline); the subsets are created by a pool of worker
+    # processes if --procs > 1.
+    def download(job):
+        date, step = job
+        filedir = get_run_dir(config.gribdir, date)
+        if not os.path.isdir(filedir):
+            try:
+                os.makedirs(filedir)
+            except:
+                if not os.path.isdir(filedir):
+                    raise Exception("Cannot create directory {:s}!".format(filedir))
+        print("Model run {:s}".format(date.strftime("%Y-%m-%d %H UTC")))
+        res = download_step(config, date, step, filedir, subset, split_files, limiter,
+                            range_gap, max_ranges, cache, inventory_revalidate)
+        # Not available: not added to the manifest, retried on the next call.
+        if res is None: bar()
+        return res
+
+    def process(job, files):
+        date, step = job
+        res = postprocess_step(config, date, step, get_run_dir(config.gribdir, date),
+                               subset, split_files, files, procs)
+        completed(job, files)
+        return res
+
+    from multiprocessing import Pool
+    procs = None if subset is None or args["procs"] == 1 else Pool(args["procs"])
+    try:
+        # A failing step does not stop the other steps (keep_going); the
+        # failed steps are not added to the manifest and retried next time.
+        pipeline = step_pipeline(download, process, args["jobs"], args["procs"],
+                                 max(max_pending, args["jobs"] + args["procs"]),
+                                 keep_going = True)
+        res = pipeline.run(jobs)
+    finally:
+        if not procs is None:
+            procs.close()
+            procs.join()
+
+    print("Processed {:d} of {:d} forecast steps ({:d} on disc, {:d} failed).".format(
+          len([x for x in res if x]), len(res) + skipped, skipped, len(pipeline.failed)))
+    for date,step in sorted(pipeline.failed.keys()):
+        print("[!] Failed: {:s} +{:03d}h: {:s}".format(date.strftime("%Y-%m-%d %H UTC"),
+              step, str(pipeline.failed[(date, step)]).replace("\n", " ")))
+    print(get_session())
+    get_session().close()
+    cache.close()
+
+    if len(pipeline.failed) > 0: sys.exit(1)
 
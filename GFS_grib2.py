@@ -0,0 +1,714 @@
+# -------------------------------------------------------------------
+# - NAME:        GFS_grib2.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2019-11-15
+# -------------------------------------------------------------------
+# - DESCRIPTION: Small pure python GRIB2 scanner. Walks trough the
+#                sections of the GRIB2 messages in a file (mmap/struct)
+#                and decodes the information needed to create the
+#                inventory (parameter, level, forecast time, period)
+#                without calling wgrib2. Only knows the parameters
+#                and levels we are using for the GFS, everything else
+#                is named similar to wgrib2 ("var0_1_2" or "lev123").
+# -------------------------------------------------------------------
+# - EDITORIAL:   2019-11-15, RS: Created file on pc24-c707.
+# -------------------------------------------------------------------
+# - L@ST MODIFIED: 2019-11-15 11:02 on pc24-c707
+# -------------------------------------------------------------------
+
+
+# Parameter names (discipline, category, number) as used by wgrib2.
+# Includes the NCEP local table entries (>= 192) used by the GFS.
+PARAMETERS = {
+    (0, 0,   0): "TMP",    (0, 0,   2): "POT",    (0, 0,   4): "TMAX",
+    (0, 0,   5): "TMIN",   (0, 0,   6): "DPT",
+    (0, 1,   0): "SPFH",   (0, 1,   1): "RH",     (0, 1,   3): "PWAT",
+    (0, 1,   7): "PRATE",  (0, 1,   8): "APCP",   (0, 1,  10): "ACPCP",
+    (0, 1,  11): "SNOD",   (0, 1,  13): "WEASD",  (0, 1,  22): "CLWMR",
+    (0, 1,  39): "CPOFP",  (0, 1, 192): "CRAIN",  (0, 1, 193): "CFRZR",
+    (0, 1, 194): "CICEP",  (0, 1, 195): "CSNOW",
+    (0, 2,   0): "WDIR",   (0, 2,   1): "WIND",   (0, 2,   2): "UGRD",
+    (0, 2,   3): "VGRD",   (0, 2,   8): "VVEL",   (0, 2,  10): "ABSV",
+    (0, 2,  22): "GUST",
+    (0, 3,   0): "PRES",   (0, 3,   1): "PRMSL",  (0, 3,   5): "HGT",
+    (0, 3, 192): "MSLET",
+    (0, 4, 192): "DSWRF",  (0, 4, 193): "USWRF",
+    (0, 5, 192): "DLWRF",  (0, 5, 193): "ULWRF",
+    (0, 6,   1): "TCDC",   (0, 6,   3): "LCDC",   (0, 6,   4): "MCDC",
+    (0, 6,   5): "HCDC",   (0, 6,   6): "CWAT",
+    (0, 7,   6): "CAPE",   (0, 7,   7): "CIN",    (0, 7, 192): "LFTX",
+    (0, 7, 193): "4LFTX",
+    (2, 0,   0): "LAND",   (2, 0, 192): "SOILW",
+    (10, 2,  0): "ICEC",
+}
+
+# Fixed surfaces without a value (code table 4.5 plus NCEP local entries)
+SURFACES = {
+      1: "surface",            2: "cloud base",          3: "cloud top",
+      4: "0C isotherm",        6: "max wind",            7: "tropopause",
+      8: "top of atmosphere", 10: "entire atmosphere",  101: "mean sea level",
+    200: "entire atmosphere (considered as a single layer)",
+    204: "highest tropospheric freezing level",
+    211: "boundary layer cloud layer",
+    212: "low cloud bottom level",         213: "low cloud top level",
+    214: "low cloud layer",                220: "planetary boundary layer",
+    222: "middle cloud bottom level",      223: "middle cloud top level",
+    224: "middle cloud layer",
+    232: "high cloud bottom level",        233: "high cloud top level",
+    234: "high cloud layer",
+    242: "convective cloud bottom level",  243: "convective cloud top level",
+    244: "convective cloud layer",
+}
+
+# Statistical processing (code table 4.10)
+STATISTICS = {0: "ave", 1: "acc", 2: "max", 3: "min"}
+
+# Indicator of unit of time (code table 4.4) in hours
+TIME_UNITS = {0: 1. / 60., 1: 1., 2: 24., 10: 3., 11: 6., 12: 12., 13: 1. / 3600.}
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _signed(x, nbits):
+    # GRIB2 uses sign and magnitude for negative integers
+    sign = 1 << (nbits - 1)
+    return -(x & (sign - 1)) if x & sign else x
+
+
+def _scaled(factor, value):
+    # Scaled value of fixed surfaces; returns None if missing
+    if factor == 255 or value == 0xffffffff: return None
+    return float(_signed(value, 32)) / 10.**_signed(factor, 8)
+
+
+def _fmt(x):
+    # Number formatting as used in the level names
+    return "{:g}".format(x)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class grib2_message(object):
+
+    __slots__ = ["number", "offset", "length", "discipline", "sections", "date",
+                 "category", "parameter", "template", "ftime", "surface1", "value1",
+                 "surface2", "value2", "statistic", "period"]
+
+    def __init__(self, buf, number, offset, length, sections):
+        """grib2_message(buf, number, offset, length, sections)
+
+        Decodes the meta information of one GRIB2 message. Usually
+        created by scan_grib2, not directly.
+
+        Parameters
+        ----------
+        buf : mmap or bytes
+            the content of the grib file
+        number : int
+            message number (1 for the first message in the file)
+        offset : int
+            byte where the message starts
+        length : int
+            length of the message in bytes
+        sections : dict
+            byte where the sections (1-7) start in "buf"
+        """
+        from struct import unpack_from
+        import datetime as dt
+
+        self.number     = number
+        self.offset     = offset
+        self.length     = length
+        self.sections   = sections
+        self.discipline = buf[offset + 6] if isinstance(buf[offset + 6], int) \
+                          else ord(buf[offset + 6])
+
+        # Section 1: reference time
+        s = sections[1]
+        year, month, day, hour, minute, second = unpack_from(">HBBBBB", buf, s + 12)
+        self.date = dt.datetime(year, month, day, hour, minute, second)
+
+        # Section 4: product definition
+        s = sections[4]
+        self.template  = unpack_from(">H", buf, s + 7)[0]
+        if not self.template in [0, 1, 8, 11]:
+            raise ValueError("product definition template 4.{:d} not supported".format(self.template))
+        self.category, self.parameter = unpack_from(">BB", buf, s + 9)
+        unit, ftime    = unpack_from(">BI", buf, s + 17)
+        self.ftime     = self._hours(unit, _signed(ftime, 32))
+        fs1, sf1, sv1, fs2, sf2, sv2 = unpack_from(">BBIBBI", buf, s + 22)
+        self.surface1  = fs1
+        self.value1    = _scaled(sf1, sv1)
+        self.surface2  = fs2
+        self.value2    = _scaled(sf2, sv2)
+
+        # Statistically processed fields (templates 4.8 and 4.11)
+        self.statistic = None
+        self.period    = None
+        if self.template in [8, 11]:
+            # Ensemble information (3 octets) before the time range (4.11)
+            s = s + (3 if self.template == 11 else 0)
+            self.statistic, unit, period = unpack_from(">BxBI", buf, s + 46)
+            self.period = self._hours(unit, period)
+
+    def _hours(self, unit, x):
+        if not unit in TIME_UNITS:
+            raise ValueError("unit of time {:d} not supported".format(unit))
+        res = x * TIME_UNITS[unit]
+        return int(res) if res == int(res) else res
+
+    def var(self):
+        """var()
+
+        Returns
+        -------
+        Name of the parameter (e.g., "TMP").
+        """
+        key = (self.discipline, self.category, self.parameter)
+        if key in PARAMETERS: return PARAMETERS[key]
+        return "var{:d}_{:d}_{:d}".format(*key)
+
+    def level(self):
+        """level()
+
+        Returns
+        -------
+        Level description as used by wgrib2 (e.g., "2 m above ground",
+        "850 mb", or "low cloud layer").
+        """
+        s1, v1, s2, v2 = self.surface1, self.value1, self.surface2, self.value2
+        layer = s2 == s1 and v2 is not None
+        if s1 == 100:
+            return "{:s}-{:s} mb".format(_fmt(v1 / 100.), _fmt(v2 / 100.)) if layer \
+                   else "{:s} mb".format(_fmt(v1 / 100.))
+        elif s1 == 102:
+            return "{:s} m above mean sea level".format(_fmt(v1))
+        elif s1 == 103:
+            return "{:s}-{:s} m above ground".format(_fmt(v1), _fmt(v2)) if layer \
+                   else "{:s} m above ground".format(_fmt(v1))
+        elif s1 == 104:
+            return "{:s}-{:s} sigma layer".format(_fmt(v1), _fmt(v2)) if layer \
+                   else "{:s} sigma level".format(_fmt(v1))
+        elif s1 == 106:
+            return "{:s}-{:s} m below ground".format(_fmt(v1), _fmt(v2)) if layer \
+                   else "{:s} m below ground".format(_fmt(v1))
+        elif s1 == 108:
+            return "{:s}-{:s} mb above ground".format(_fmt(v1 / 100.), _fmt(v2 / 100.)) if layer \
+                   else "{:s} mb above ground".format(_fmt(v1 / 100.))
+        elif s1 in SURFACES:
+            return SURFACES[s1]
+        return "lev{:d}".format(s1)
+
+    def time(self):
+        """time()
+
+        Returns
+        -------
+        Forecast time as used by wgrib2 (e.g., "18 hour fcst" or
+        "12-18 hour acc fcst"); "anl" for analyses.
+        """
+        if self.statistic is None:
+            if self.ftime == 0: return "anl"
+            return "{:s} hour fcst".format(_fmt(self.ftime))
+        stat = STATISTICS[self.statistic] if self.statistic in STATISTICS \
+               else "stat{:d}".format(self.statistic)
+        return "{:s}-{:s} hour {:s} fcst".format(_fmt(self.ftime),
+               _fmt(self.ftime + self.period), stat)
+
+    def step(self):
+        """step()
+
+        Returns
+        -------
+        Forecast step in hours (end of the period for statistically
+        processed fields).
+        """
+        return self.ftime if self.period is None else self.ftime + self.period
+
+    def record(self):
+        """record()
+
+        Returns
+        -------
+        Returns the tuple used to create the idx_entry objects in
+        GFS_download.py (same as parsing the inventory line).
+        """
+        lev = self.level().replace(".", "-")
+        if self.statistic is None:
+            return ("{:d}".format(self.offset), self.var(), lev,
+                    "{:s}".format(_fmt(self.ftime)), "hour", "")
+        stat = STATISTICS[self.statistic] if self.statistic in STATISTICS \
+               else "stat{:d}".format(self.statistic)
+        return ("{:d}".format(self.offset), self.var(), lev,
+                "{:s}-{:s}".format(_fmt(self.ftime), _fmt(self.step())).replace(".", "-"),
+                "hour", "{:s} ".format(stat))
+
+    def inventory(self):
+        """inventory()
+
+        Returns
+        -------
+        Returns one line of the inventory, the same format as wgrib2 uses
+        (<number>:<byte>:d=<YYYYmmddHH>:<param>:<level>:<time>:).
+        """
+        return "{:d}:{:d}:d={:s}:{:s}:{:s}:{:s}:".format(self.number, self.offset,
+               self.date.strftime("%Y%m%d%H"), self.var(), self.level(), self.time())
+
+    def __repr__(self):
+        return "GRIB2 MESSAGE: {:s}".format(self.inventory())
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def scan_grib2(file):
+    """scan_grib2(file)
+
+    Scans a local GRIB2 file and decodes the meta information
+    of all messages. Bytes between the messages are skipped (as wgrib2
+    does). If a message contains several fields (repeated sections
+    2-7) only the first field is considered.
+
+    Parameters
+    ----------
+    file : str
+        name of the GRIB2 file
+
+    Returns
+    -------
+    Returns a list of grib2_message objects.
+    """
+    import os
+    import mmap
+    from struct import unpack_from
+
+    if not os.path.isfile(file):
+        raise Exception("file {:s} does not exist on disc".format(file))
+    if os.path.getsize(file) == 0: return []
+
+    res = []
+    with open(file, "rb") as fid:
+        buf = mmap.mmap(fid.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            pos = buf.find(b"GRIB", 0)
+            while pos >= 0 and pos + 16 <= len(buf):
+                edition = unpack_from(">B", buf, pos + 7)[0]
+                length  = unpack_from(">Q", buf, pos + 8)[0]
+                if not edition == 2:
+                    raise Exception("GRIB edition {:d} at byte {:d}, only GRIB2 supported".format(
+                                    edition, pos))
+                if pos + length > len(buf) or not buf[pos + length - 4:pos + length] == b"7777":
+                    raise Exception("incomplete GRIB2 message at byte {:d}".format(pos))
+
+                # Find sections 1-7 (first field only)
+                sections = {}
+                s = pos + 16
+                while s < pos + length - 4:
+                    slen, snum = unpack_from(">IB", buf, s)
+                    if snum in sections: break
+                    sections[snum] = s
+                    s += slen
+                res.append(grib2_message(buf, len(res) + 1, pos, length, sections))
+
+                pos = buf.find(b"GRIB", pos + length)
+        finally:
+            buf.close()
+
+    return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def inventory(file):
+    """inventory(file)
+
+    Parameters
+    ----------
+    file : str
+        name of the GRIB2 file
+
+    Returns
+    -------
+    Returns the inventory of a local GRIB2 file as a list of strings
+    (same format as wgrib2 or the .idx files on the server).
+    """
+    return [x.inventory() for x in scan_grib2(file)]
+
+
+# -------------------------------------------------------------------
+# Decoding the data (simple and complex packing, templates 5.0,
+# 5.2, 5.3), spatial subsets, and encoding (simple packing).
+# -------------------------------------------------------------------
+def _unsigned(x, nbits):
+    # Inverse of _signed
+    return (-x) | (1 << (nbits - 1)) if x < 0 else x
+
+
+def _bits(data, offsets, widths):
+    # Extracts unsigned integers of the given widths (bits, <= 56) starting
+    # at the given bit offsets. data is a numpy uint8 array (padded with
+    # at least 8 zero bytes).
+    import numpy as np
+    from numpy.lib.stride_tricks import as_strided
+    # 8 bytes starting at each offset, interpreted as big endian integer
+    rows = as_strided(data, shape = (len(data) - 7, 8), strides = (data.strides[0],) * 2)
+    word = rows[offsets // 8].copy().view(">u8").ravel().astype(np.uint64)
+    shift = (64 - offsets % 8 - widths).astype(np.uint64)
+    mask  = (np.uint64(1) << widths.astype(np.uint64)) - np.uint64(1)
+    return ((word >> shift) & mask).astype(np.int64)
+
+
+def _bits_fixed(data, start, nbits, n):
+    # n unsigned integers with nbits bits each, starting at bit "start"
+    import numpy as np
+    if nbits == 0: return np.zeros(n, dtype = np.int64)
+    offsets = start + np.arange(n, dtype = np.int64) * nbits
+    return _bits(data, offsets, np.repeat(np.int64(nbits), n))
+
+
+def _pack(x, nbits):
+    # Packs the non-negative integers x (nbits each) into bytes
+    import numpy as np
+    if nbits == 0 or len(x) == 0: return b""
+    shifts = np.arange(nbits - 1, -1, -1, dtype = np.uint64)
+    bits   = (x.astype(np.uint64)[:,None] >> shifts) & np.uint64(1)
+    return np.packbits(bits.astype(np.uint8).ravel()).tobytes()
+
+
+def decode_grid(buf, msg):
+    """decode_grid(buf, msg)
+
+    Decodes the grid definition (section 3) of a message. Only regular
+    latitude/longitude grids (template 3.0) are supported.
+
+    Parameters
+    ----------
+    buf : mmap or bytes
+        the content of the grib file
+    msg : grib2_message
+        the message (see scan_grib2)
+
+    Returns
+    -------
+    Dictionary with ni, nj, la1, lo1, la2, lo2, di, dj (degrees)
+    and the scanning mode (scan).
+    """
+    from struct import unpack_from
+    s = msg.sections[3]
+    length, template = unpack_from(">I", buf, s)[0], unpack_from(">H", buf, s + 12)[0]
+    if not template == 0 or not unpack_from(">B", buf, s + 10)[0] == 0:
+        raise NotImplementedError("grid definition template 3.{:d} not supported".format(template))
+    # Template 3.0: the fields decoded end at octet 72
+    if length < 72:
+        raise Exception("corrupt grid definition (section 3 of {:d} bytes)".format(length))
+    ni, nj, basic = unpack_from(">III", buf, s + 30)
+    la1, lo1 = unpack_from(">II", buf, s + 46)
+    la2, lo2, di, dj, scan = unpack_from(">IIIIB", buf, s + 55)
+    if not basic in [0, 0xffffffff]:
+        raise NotImplementedError("basic angle of the initial production domain not supported")
+    return {"ni": ni, "nj": nj, "scan": scan,
+            "la1": _signed(la1, 32) * 1e-6, "lo1": _signed(lo1, 32) * 1e-6,
+            "la2": _signed(la2, 32) * 1e-6, "lo2": _signed(lo2, 32) * 1e-6,
+            "di": di * 1e-6, "dj": dj * 1e-6}
+
+
+def decode_values(buf, msg):
+    """decode_values(buf, msg)
+
+    Decodes the data of a message. Supports simple packing (5.0)
+    and complex packing with/without spatial differencing (5.2, 5.3),
+    with or without bitmap.
+
+    Parameters
+    ----------
+    buf : mmap or bytes
+        the content of the grib file
+    msg : grib2_message
+        the message (see scan_grib2)
+
+    Returns
+    -------
+    numpy.ndarray of length ni * nj in the order of the grid points
+    in the file (see decode_grid); missing values are set to numpy.nan.
+    """
+    import numpy as np
+    from struct import unpack_from
+
+    # Section 5: data representation
+    s = msg.sections[5]
+    nvalues, template = unpack_from(">IH", buf, s + 5)
+    if not template in [0, 2, 3]:
+        raise NotImplementedError("data representation template 5.{:d} not supported".format(template))
+    R, E, D, nbits = unpack_from(">fHHB", buf, s + 11)
+    E, D = _signed(E, 16), _signed(D, 16)
+
+    # Section 6: bitmap
+    s6 = msg.sections[6]
+    indicator = unpack_from(">B", buf, s6 + 5)[0]
+    if indicator == 0:
+        length = unpack_from(">I", buf, s6)[0]
+        bitmap = np.unpackbits(np.frombuffer(buf[s6 + 6:s6 + length], dtype = np.uint8)).astype(bool)
+    elif indicator == 255:
+        bitmap = None
+    else:
+        raise NotImplementedError("bitmap indicator {:d} not supported".format(indicator))
+
+    # Section 7: data
+    s7     = msg.sections[7]
+    length = unpack_from(">I", buf, s7)[0]
+    data   = np.frombuffer(buf[s7 + 5:s7 + length] + b"\x00" * 8, dtype = np.uint8)
+
+    missing = None
+    if template == 0:
+        Z = _bits_fixed(data, 0, nbits, nvalues)
+    else:
+        Z, missing = _complex_unpack(buf, s, template, nbits, nvalues, data)
+
+    res = (R + Z * 2.**E) / 10.**D
+    if missing is not None: res[missing] = np.nan
+
+    if bitmap is None: return res
+    npoints = unpack_from(">I", buf, msg.sections[3] + 6)[0]
+    full = np.repeat(np.nan, npoints)
+    full[bitmap[:npoints]] = res
+    return full
+
+
+def _complex_unpack(buf, s, template, nbits, nvalues, data):
+    # Complex packing (5.2) and complex packing with spatial
+    # differencing (5.3). Returns the integer values and the
+    # missing value flags (or None).
+    import numpy as np
+    from struct import unpack_from
+
+    mgmt = unpack_from(">B", buf, s + 22)[0]
+    ng, refw, bw, refl, linc, last, bl = unpack_from(">IBBIBIB", buf, s + 31)
+
+    pos = 0
+    if template == 3:
+        order, noctets = unpack_from(">BB", buf, s + 47)
+        if not order in [1, 2]:
+            raise NotImplementedError("order {:d} of spatial differencing not supported".format(order))
+        extra = []
+        for k in range(order + 1):
+            val = 0
+            for x in data[pos // 8:pos // 8 + noctets]: val = val * 256 + int(x)
+            extra.append(_signed(val, 8 * noctets) if noctets > 0 else 0)
+            pos += 8 * noctets
+        ival, minsd = extra[:order], extra[order]
+
+    # Group reference values, widths, and lengths (each octet aligned)
+    ceil8 = lambda x: (x + 7) // 8 * 8
+    ref   = _bits_fixed(data, pos, nbits, ng);      pos = ceil8(pos + ng * nbits)
+    width = _bits_fixed(data, pos, bw, ng) + refw;  pos = ceil8(pos + ng * bw)
+    lens  = _bits_fixed(data, pos, bl, ng) * linc + refl;  pos = ceil8(pos + ng * bl)
+    lens[-1] = last
+    if not lens.sum() == nvalues:
+        raise Exception("corrupt complex packing (group lengths do not match)")
+
+    widths  = np.repeat(width, lens)
+    offsets = pos + np.concatenate(([0], np.cumsum(widths)[:-1])).astype(np.int64)
+    X = _bits(data, offsets, widths)
+
+    # Missing values
+    missing = None
+    if mgmt in [1, 2]:
+        gref = np.repeat(ref, lens)
+        full = np.where(widths > 0, (1 << widths) - 1, -1)
+        missing = np.where(widths > 0, X == full, gref == (1 << nbits) - 1)
+        if mgmt == 2:
+            missing |= np.where(widths > 0, X == full - 1, gref == (1 << nbits) - 2)
+
+    Z = X + np.repeat(ref, lens)
+
+    # Spatial differencing (only non-missing values)
+    if template == 3:
+        z = (Z if missing is None else Z[~missing]).copy()
+        n = len(z)
+        z[order:] += minsd
+        if order == 1:
+            # v[i] = z[i] + minsd + v[i-1]
+            if n > 0: z[0] = ival[0]
+            z = np.cumsum(z)
+        elif n > 1:
+            # v[i] = z[i] + minsd + 2 v[i-1] - v[i-2] (first differences: cumsum)
+            diff    = z[1:].copy()
+            diff[0] = ival[1] - ival[0]
+            z = ival[0] + np.concatenate(([0], np.cumsum(diff)))
+        elif n == 1:
+            z[0] = ival[0]
+        if missing is None: Z = z
+        else:               Z[~missing] = z
+
+    return Z, missing
+
+
+def _subset_index(grid, subset):
+    # Indices of the rows and columns inside the subset (dict with
+    # W, E, S, N), and the definition of the new grid.
+    import numpy as np
+    if not grid["scan"] in [0, 64]:
+        raise NotImplementedError("scanning mode {:d} not supported".format(grid["scan"]))
+    eps = 1e-6
+    lat = grid["la1"] + np.arange(grid["nj"]) * grid["dj"] * (1. if grid["scan"] & 64 else -1.)
+    lon = grid["lo1"] + np.arange(grid["ni"]) * grid["di"]
+    rows  = np.flatnonzero((lat >= subset["S"] - eps) & (lat <= subset["N"] + eps))
+    width = subset["E"] - subset["W"]
+    if width < 0 or width > 360: width = width % 360.
+    dlon  = (lon - subset["W"]) % 360.
+    cols  = np.flatnonzero(dlon <= width + eps)
+    cols  = cols[np.argsort(dlon[cols], kind = "mergesort")]
+    if len(rows) == 0 or len(cols) == 0:
+        raise ValueError("subset does not overlap with the grid")
+    new = dict(grid)
+    new.update({"ni": len(cols), "nj": len(rows),
+                "la1": lat[rows[0]], "la2": lat[rows[-1]],
+                "lo1": lon[cols[0]] % 360., "lo2": lon[cols[-1]] % 360.})
+    return rows, cols, new
+
+
+def _encode_section3(buf, msg, grid):
+    # Copy of section 3 with the new grid dimensions/corners
+    from struct import pack, unpack_from
+    s   = msg.sections[3]
+    sec = bytearray(buf[s:s + unpack_from(">I", buf, s)[0]])
+    u   = lambda x: _unsigned(int(round(x * 1e6)), 32)
+    sec[6:10]  = pack(">I", grid["ni"] * grid["nj"])
+    sec[30:38] = pack(">II", grid["ni"], grid["nj"])
+    sec[46:54] = pack(">II", u(grid["la1"]), u(grid["lo1"]))
+    sec[55:63] = pack(">II", u(grid["la2"]), u(grid["lo2"]))
+    return bytes(sec)
+
+
+def encode_message(buf, msg, sec3, values):
+    """encode_message(buf, msg, sec3, values)
+
+    Creates a new GRIB2 message (simple packing, template 5.0) with the
+    identification and product definition of msg. The decimal and
+    binary scale factors of msg are kept, such that no precision is lost.
+
+    Parameters
+    ----------
+    buf : mmap or bytes
+        the content of the grib file
+    msg : grib2_message
+        the message (see scan_grib2)
+    sec3 : bytes
+        grid definition section of the new message
+    values : numpy.ndarray
+        the values (numpy.nan for missing values) in the order
+        of the grid points.
+
+    Returns
+    -------
+    Returns the message (bytes).
+    """
+    import numpy as np
+    from struct import pack, unpack_from
+
+    s = msg.sections[5]
+    E, D = [_signed(x, 16) for x in unpack_from(">HH", buf, s + 15)]
+    original = unpack_from(">B", buf, s + 20)[0]
+
+    # Bitmap if there are missing values
+    values = np.asarray(values, dtype = np.float64).ravel()
+    valid  = ~np.isnan(values)
+    if valid.all():
+        sec6 = pack(">IBB", 6, 6, 255)
+    else:
+        bitmap = np.packbits(valid.astype(np.uint8)).tobytes()
+        sec6   = pack(">IBB", 6 + len(bitmap), 6, 0) + bitmap
+        values = values[valid]
+
+    # Simple packing. The values are integers relative to the original
+    # reference value, keep it (or shift it if exactly representable).
+    R0     = np.float32(unpack_from(">f", buf, s + 11)[0])
+    scaled = values * 10.**D
+    X = np.round((scaled - R0) / 2.**E).astype(np.int64)
+    k = int(X.min()) if len(X) > 0 else 0
+    if k >= 0 and float(np.float32(R0 + k * 2.**E)) == float(R0) + k * 2.**E:
+        R, X = np.float32(R0 + k * 2.**E), X - k
+    elif k >= 0:
+        R = R0
+    else:
+        R = np.float32(scaled.min())
+        if R > scaled.min(): R = np.nextafter(R, np.float32(-np.inf))
+        X = np.maximum(np.round((scaled - R) / 2.**E), 0).astype(np.int64)
+    nbits = int(X.max()).bit_length() if len(X) > 0 else 0
+    data  = _pack(X, nbits)
+    sec5  = pack(">IBIH", 21, 5, len(values), 0) + pack(">f", R) + \
+            pack(">HHBB", _unsigned(E, 16), _unsigned(D, 16), nbits, original)
+    sec7  = pack(">IB", 5 + len(data), 7) + data
+
+    s1, s4 = msg.sections[1], msg.sections[4]
+    sec1 = bytes(buf[s1:s1 + unpack_from(">I", buf, s1)[0]])
+    sec4 = bytes(buf[s4:s4 + unpack_from(">I", buf, s4)[0]])
+    body = sec1 + sec3 + sec4 + sec5 + sec6 + sec7 + b"7777"
+    return b"GRIB" + pack(">HBBQ", 0, msg.discipline, 2, 16 + len(body)) + body
+
+
+# Index bounds of the subsets, per grid definition (section 3) and area
+_subset_cache = {}
+
+def subset_grib2(gribfile, subsetfile, subset):
+    """subset_grib2(gribfile, subsetfile, subset)
+
+    Creates a spatial subset of all messages in a GRIB2 file (same as
+    "wgrib2 <gribfile> -small_grib W:E S:N <subsetfile>"). The data are
+    decoded, the grid points inside the area are taken (the indices are
+    computed once per grid), and written using simple packing.
+    Raises a NotImplementedError if the file contains grids or packings
+    which are not supported (see decode_grid, decode_values).
+
+    Parameters
+    ----------
+    gribfile : str
+        name of the GRIB2 file
+    subsetfile : str
+        name of the output file
+    subset : dict
+        the area, dictionary with W, E, S, N (degrees).
+
+    Returns
+    -------
+    Returns the number of messages written.
+    """
+    import os
+    import mmap
+    import numpy as np
+
+    messages = scan_grib2(gribfile)
+    with open(gribfile, "rb") as fid:
+        buf = mmap.mmap(fid.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            with open("{:s}.part".format(subsetfile), "wb") as out:
+                for msg in messages:
+                    s3  = msg.sections[3]
+                    key = (bytes(buf[s3:msg.sections[4]]), subset["W"], subset["E"],
+                           subset["S"], subset["N"])
+                    if not key in _subset_cache:
+                        grid = decode_grid(buf, msg)
+                        rows, cols, new = _subset_index(grid, subset)
+                        _subset_cache[key] = (grid, rows, cols, _encode_section3(buf, msg, new))
+                    grid, rows, cols, sec3 = _subset_cache[key]
+                    values = decode_values(buf, msg).reshape((grid["nj"], grid["ni"]))
+                    out.write(encode_message(buf, msg, sec3, values[np.ix_(rows, cols)]))
+        except:
+            if os.path.isfile("{:s}.part".format(subsetfile)):
+                os.remove("{:s}.part".format(subsetfile))
+            raise
+        finally:
+            buf.close()
+    os.rename("{:s}.part".format(subsetfile), subsetfile)
+
+    return len(messages)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import sys
+    if not len(sys.argv) == 2:
+        sys.exit("Usage: python GFS_grib2.py <grib2 file>")
+    for line in inventory(sys.argv[1]): print(line)
+
@@ -0,0 +1,699 @@
+# -------------------------------------------------------------------
+# - NAME:        GFS_interpolate.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2019-11-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Bilinear interpolation of the combined GFS NetCDF
+#                files (see GFS_combine.py) to a set of stations.
+#                Python version of nc_bilinear_on_file (mospack):
+#                the neighbouring grid points and the weights are
+#                computed once per grid, all parameters and times are
+#                interpolated at once (numpy.einsum). Stores one
+#                array (station, param, time) per model run.
+# -------------------------------------------------------------------
+# - EDITORIAL:   2019-11-18, RS: Created file on pc24-c707.
+# -------------------------------------------------------------------
+# - L@ST MODIFIED: 2019-11-18 10:21 on pc24-c707
+# -------------------------------------------------------------------
+
+
+# Default stations (same as in GFS_interpolate.R)
+STATIONS = [("BER", 13.394, 52.514), ("IBK", 11.365, 47.257), ("ZUR", 8.563, 47.418),
+            ("LEI", 12.195, 51.447), ("VIE", 16.425, 48.193)]
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def read_stations(file):
+   """read_stations(file)
+
+   Reads a station list from a text file (semicolon separated, with
+   header; columns statnr, lon, lat as mospack/data/*.csv).
+
+   Parameters
+   ----------
+   file : str
+      name of the file
+
+   Returns
+   -------
+   Returns a list of (statnr, lon, lat) tuples.
+   """
+   import os
+   if not os.path.isfile(file):
+      raise Exception("file {:s} does not exist".format(file))
+
+   res = []
+   with open(file, "r") as fid:
+      header = None
+      for line in fid:
+         line = line.strip()
+         if len(line) == 0 or line.startswith("#"): continue
+         line = [x.strip() for x in line.split(";")]
+         if header is None:
+            header = line
+            if not all([x in header for x in ["statnr", "lon", "lat"]]):
+               raise ValueError("{:s} has to contain the columns statnr, lon, and lat".format(file))
+            continue
+         line = dict(zip(header, line))
+         res.append((line["statnr"], float(line["lon"]), float(line["lat"])))
+   return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def neighbours(stations, maskfile = "mospack/data/neighbourmask.csv"):
+   """neighbours(stations, maskfile = "mospack/data/neighbourmask.csv")
+
+   Adds the neighbouring locations for each station, same as
+   mospack::neighbours (the station "BER" becomes "C.BER", "N.BER", ...).
+
+   Parameters
+   ----------
+   stations : list
+      list of (statnr, lon, lat) tuples
+   maskfile : str
+      file with the neighbour mask (name; lon; lat offsets in degrees)
+
+   Returns
+   -------
+   Returns a list of (statnr, lon, lat) tuples.
+   """
+   mask = []
+   with open(maskfile, "r") as fid:
+      for line in fid.readlines()[1:]:
+         line = [x.strip() for x in line.split(";")]
+         if len(line) == 3: mask.append((line[0], float(line[1]), float(line[2])))
+
+   return [("{:s}.{:s}".format(name, stn), lon + dlon, lat + dlat) \
+           for stn, lon, lat in stations for name, dlon, dlat in mask]
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def bilinear_weights(lons, lats, stations):
+   """bilinear_weights(lons, lats, stations)
+
+   Computes the index of the four neighbouring grid points and the
+   bilinear interpolation weights for a set of stations on a regular
+   longitude/latitude grid.
+
+   Parameters
+   ----------
+   lons : numpy.ndarray
+      longitudes of the grid (increasing)
+   lats : numpy.ndarray
+      latitudes of the grid (increasing or decreasing)
+   stations : list
+      list of (statnr, lon, lat) tuples
+
+   Returns
+   -------
+   Returns a dictionary with "index", the (flat) index of the four
+   grid points (SW, SE, NW, NE) in a (latitude, longitude) field,
+   numpy.ndarray of shape (stations, 4), and "weights", the weights of
+   the four grid points (numpy.ndarray (stations, 4); NaN for stations
+   outside the grid).
+   """
+   import numpy as np
+
+   lons = np.asarray(lons, dtype = float)
+   lats = np.asarray(lats, dtype = float)
+   if len(lons) < 2 or len(lats) < 2:
+      raise ValueError("grid needs at least two longitudes and two latitudes")
+   if np.any(np.diff(lons) <= 0):
+      raise ValueError("longitudes have to be increasing")
+
+   # Station coordinates, longitudes within [lons[0], lons[0] + 360)
+   x = np.asarray([s[1] for s in stations], dtype = float)
+   y = np.asarray([s[2] for s in stations], dtype = float)
+   x = lons[0] + np.mod(x - lons[0], 360.)
+
+   # Latitudes decreasing: index on the flipped axis
+   flip = lats[0] > lats[-1]
+   lat  = lats[::-1] if flip else lats
+
+   # Index of the grid point west/south of (or on) the station
+   i0 = np.clip(np.searchsorted(lons, x, side = "right") - 1, 0, len(lons) - 2)
+   j0 = np.clip(np.searchsorted(lat,  y, side = "right") - 1, 0, len(lat) - 2)
+   wx = (x - lons[i0]) / (lons[i0 + 1] - lons[i0])
+   wy = (y - lat[j0])  / (lat[j0 + 1] - lat[j0])
+   outside = (wx < 0) | (wx > 1) | (wy < 0) | (wy > 1)
+
+   if flip: j0, j1 = len(lat) - 1 - j0, len(lat) - 2 - j0
+   else:    j1 = j0 + 1
+
+   ni    = len(lons)
+   index = np.column_stack((j0 * ni + i0, j0 * ni + i0 + 1, j1 * ni + i0, j1 * ni + i0 + 1))
+   weights = np.column_stack(((1. - wy) * (1. - wx), (1. - wy) * wx, wy * (1. - wx), wy * wx))
+   weights[outside] = np.nan
+
+   return {"index": index, "weights": weights}
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def read_netcdf(ncfile, index = None):
+   """read_netcdf(ncfile, index = None)
+
+   Reads a NetCDF file created by GFS_combine.py (layout "wgrib2"
+   or "stacked"). If index is given only the rows/columns of the grid
+   containing these grid points are read.
+
+   Parameters
+   ----------
+   ncfile : str
+      name of the NetCDF file
+   index : None or numpy.ndarray
+      flat index of the grid points needed (see bilinear_weights)
+
+   Returns
+   -------
+   Returns a dictionary with "data" (numpy.ndarray, (param, time,
+   latitude, longitude), missing values are NaN), "param" (names),
+   "time" (seconds since 1970-01-01), "latitude" and "longitude", and
+   "index", the index in the (latitude, longitude) field read
+   (None if index is None).
+   """
+   import numpy as np
+   from netCDF4 import Dataset
+
+   nc = Dataset(ncfile, "r")
+   try:
+      lats = nc.variables["latitude"][:].filled(np.nan)
+      lons = nc.variables["longitude"][:].filled(np.nan)
+      time = nc.variables["time"][:].filled(np.nan)
+
+      # Only read the box containing the grid points needed
+      rows, cols = slice(None), slice(None)
+      if not index is None:
+         rows, cols, index = _grid_box(index, (len(lats), len(lons)))
+
+      layout = nc.getncattr("layout") if "layout" in nc.ncattrs() else "wgrib2"
+      if layout == "stacked":
+         params = list(nc.variables["param"][:])
+         data   = nc.variables["data"][:, :, rows, cols]
+      else:
+         params = sorted([x for x, var in nc.variables.items() \
+                          if var.dimensions == ("time", "latitude", "longitude")])
+         data   = np.ma.stack([nc.variables[x][:, rows, cols] for x in params])
+   finally:
+      nc.close()
+
+   return {"data": np.ma.filled(data.astype(np.float32), np.nan), "param": params,
+           "time": time, "latitude": lats, "longitude": lons, "index": index}
+
+
+def _grid_box(index, shape):
+   # Smallest box (rows, columns) of a (latitude, longitude) field of
+   # dimension "shape" containing all grid points "index" (flat index).
+   # Returns the slices and the flat index of the grid points in the box.
+   import numpy as np
+   j, i = np.unravel_index(index, shape)
+   rows = slice(int(j.min()), int(j.max()) + 1)
+   cols = slice(int(i.min()), int(i.max()) + 1)
+   return rows, cols, np.ravel_multi_index((j - rows.start, i - cols.start),
+                                           (rows.stop - rows.start, cols.stop - cols.start))
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class weights_cache(object):
+
+   def __init__(self, cachedir):
+      """weights_cache(cachedir)
+
+      Persistent cache for the interpolation weights (see
+      bilinear_weights). One .npz file per grid and set of stations
+      (file name contains a hash of the longitudes/latitudes of the
+      grid and a hash of the stations), containing the index and
+      weights of the neighbouring grid points and the sparse
+      interpolation operator (CSR; rows: stations, columns: grid points
+      used, see interpolate). The operator is used if scipy
+      is installed, else interpolate falls back to numpy.einsum.
+
+      Parameters
+      ----------
+      cachedir : str
+         directory where the weights are stored, created if needed
+      """
+      import os
+      if not os.path.isdir(cachedir): os.makedirs(cachedir)
+      self.cachedir = cachedir
+      self._cache   = {}
+
+   def get_file_name(self, lons, lats, stations):
+      """get_file_name(lons, lats, stations)
+
+      Parameters
+      ----------
+      lons, lats, stations : see bilinear_weights
+
+      Returns
+      -------
+      Returns the name of the cache file for this grid and set of stations.
+      """
+      import os
+      import hashlib
+      import numpy as np
+      grid = hashlib.md5(np.asarray(lons, dtype = np.float64).tobytes() + b":" + \
+                         np.asarray(lats, dtype = np.float64).tobytes()).hexdigest()
+      stns = hashlib.md5(repr([(str(x[0]), float(x[1]), float(x[2])) \
+                               for x in stations]).encode("utf-8")).hexdigest()
+      return os.path.join(self.cachedir, "weights_{:s}_{:s}.npz".format(grid[:16], stns[:16]))
+
+   def get(self, lons, lats, stations):
+      """get(lons, lats, stations)
+
+      Returns the weights, loaded from the cache if available, else
+      computed and stored.
+
+      Parameters
+      ----------
+      lons, lats, stations : see bilinear_weights
+
+      Returns
+      -------
+      Returns a dictionary with "index" and "weights" (see bilinear_weights),
+      "box" (index of the neighbouring grid points in the box read by
+      read_netcdf) and "operator" (scipy.sparse.csr_matrix, see interpolate;
+      None if scipy is not available).
+      """
+      import os
+      import numpy as np
+
+      file = self.get_file_name(lons, lats, stations)
+      if file in self._cache: return self._cache[file]
+
+      if os.path.isfile(file):
+         with np.load(file) as tmp:
+            res = dict([(x, tmp[x]) for x in tmp.files])
+      else:
+         res = bilinear_weights(lons, lats, stations)
+         res["box"] = _grid_box(res["index"], (len(lats), len(lons)))[2]
+         # Sparse operator (CSR): four grid points per station, the
+         # columns are the grid points used (np.unique(box)).
+         columns = np.unique(res["box"])
+         res["columns"] = np.searchsorted(columns, res["box"])
+         res["indptr"]  = np.arange(0, 4 * res["index"].shape[0] + 1, 4)
+         res["shape"]   = np.asarray([res["index"].shape[0], len(columns)])
+         tmpfile = "{:s}.part".format(file)
+         with open(tmpfile, "wb") as fid: np.savez(fid, **res)
+         os.rename(tmpfile, file)
+
+      try:
+         from scipy.sparse import csr_matrix
+         res["operator"] = csr_matrix((res["weights"].ravel(), res["columns"].ravel(), res["indptr"]),
+                                      shape = tuple(res["shape"]))
+      except ImportError:
+         res["operator"] = None
+
+      self._cache[file] = res
+      return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def interpolate(data, index, weights, operator = None):
+   """interpolate(data, index, weights, operator = None)
+
+   Bilinear interpolation of all parameters and times at once. If
+   the sparse operator is given (see weights_cache) the interpolation
+   is one sparse matrix multiplication, else numpy.einsum is used.
+
+   Parameters
+   ----------
+   data : numpy.ndarray
+      the data, dimension (param, time, latitude, longitude)
+   index : numpy.ndarray
+      flat index of the four neighbouring grid points (stations, 4),
+      see bilinear_weights
+   weights : numpy.ndarray
+      the weights (stations, 4), see bilinear_weights
+   operator : None or scipy.sparse matrix
+      sparse interpolation operator (see weights_cache); rows are the
+      stations, columns the grid points used (numpy.unique(index)).
+
+   Returns
+   -------
+   Returns a numpy.ndarray of dimension (station, param, time).
+   """
+   import numpy as np
+   shape = data.shape[:2]
+   data  = data.reshape(shape + (-1,))
+   if operator is None:
+      return np.einsum("ptsk,sk->spt", data[:, :, index], weights)
+   columns = np.unique(index)
+   if not operator.shape == (index.shape[0], len(columns)):
+      raise ValueError("operator does not match the index")
+   data = data.reshape((-1, data.shape[2]))[:, columns]
+   return np.asarray(operator.dot(data.T)).reshape((operator.shape[0],) + shape)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def get_output_file_name(ipdir, date):
+   """get_output_file_name(ipdir, date)
+
+   Parameters
+   ----------
+   ipdir : str
+      path where the files should be stored
+   date : datetime object
+      date and time of model initialization
+
+   Returns
+   -------
+   Returns the name of the output file (numpy .npz file).
+   """
+   from os.path import join
+   return join(ipdir, "GFS_{:s}_interpolated.npz".format(date.strftime("%Y%m%d_%H%M")))
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def interpolate_file(ncfile, outfile, stations, cache = None):
+   """interpolate_file(ncfile, outfile, stations, cache = None)
+
+   Interpolates one NetCDF file (see GFS_combine.py) and stores the
+   result into a numpy .npz file containing "data" (station, param,
+   time), "station", "param", and "time" (seconds since 1970-01-01).
+   The file is written as "<outfile>.part" and renamed when complete.
+
+   Parameters
+   ----------
+   ncfile : str
+      name of the NetCDF file
+   outfile : str
+      name of the output file (.npz)
+   stations : list
+      list of (statnr, lon, lat) tuples
+   cache : None or weights_cache
+      cache for the interpolation weights, the weights are computed
+      (see bilinear_weights) if None.
+
+   Returns
+   -------
+   Returns the interpolated data (numpy.ndarray, (station, param, time)).
+   """
+   import os
+   import numpy as np
+   from netCDF4 import Dataset
+
+   # Grid, get weights (once per grid)
+   nc = Dataset(ncfile, "r")
+   try:
+      lats = nc.variables["latitude"][:].filled(np.nan)
+      lons = nc.variables["longitude"][:].filled(np.nan)
+   finally:
+      nc.close()
+   if cache is None:
+      w = bilinear_weights(lons, lats, stations)
+      w["operator"] = None
+   else:
+      w = cache.get(lons, lats, stations)
+
+   # Reading the data needed, interpolate
+   data = read_netcdf(ncfile, w["index"])
+   res  = interpolate(data["data"], data["index"], w["weights"], w["operator"])
+
+   tmpfile = "{:s}.part".format(outfile)
+   with open(tmpfile, "wb") as fid:
+      np.savez(fid, data = res, station = np.asarray([x[0] for x in stations]),
+               param = np.asarray(data["param"]), time = data["time"])
+   os.rename(tmpfile, outfile)
+
+   return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class station_archive(object):
+
+   HEADER = "header.json"
+   DATA   = "data.f4"
+
+   def __init__(self, directory, stations = None, params = None, steps = None):
+      """station_archive(directory, stations = None, params = None, steps = None)
+
+      Append-only archive of the interpolated forecasts of all model
+      runs. The data are stored in one binary file (float32, C order)
+      of dimension (init, station, param, step); each model run
+      (init) is appended at the end. A small JSON header describes the
+      axes (stations, parameters, forecast steps, model initializations).
+      The data are accessed via numpy.memmap, e.g., all model runs for
+      one station and parameter (see get) are a view, nothing is loaded
+      until used.
+
+      Parameters
+      ----------
+      directory : str
+         directory of the archive. If the archive does not exist
+         it is created, requires stations, params, and steps.
+      stations : None or list
+         names of the stations (statnr)
+      params : None or list
+         names of the parameters
+      steps : None or list
+         forecast steps (hours)
+      """
+      import os
+      import json
+
+      self.directory = directory
+      self._header   = os.path.join(directory, self.HEADER)
+      self._data     = os.path.join(directory, self.DATA)
+
+      if os.path.isfile(self._header):
+         with open(self._header, "r") as fid: header = json.load(fid)
+         self.stations = header["station"]
+         self.params   = header["param"]
+         self.steps    = header["step"]
+         self.inits    = header["init"]
+      else:
+         if stations is None or params is None or steps is None:
+            raise ValueError("stations, params, and steps required to create a new archive")
+         if not os.path.isdir(directory): os.makedirs(directory)
+         self.stations = [str(x) for x in stations]
+         self.params   = [str(x) for x in params]
+         self.steps    = [int(x) if x == int(x) else float(x) for x in steps]
+         self.inits    = []
+         open(self._data, "wb").close()
+         self._write_header()
+
+   @property
+   def shape(self):
+      return (len(self.inits), len(self.stations), len(self.params), len(self.steps))
+
+   def _write_header(self):
+      import os
+      import json
+      header = {"dtype": "<f4", "order": "C", "dims": ["init", "station", "param", "step"],
+                "shape": list(self.shape), "station": self.stations, "param": self.params,
+                "step": self.steps, "init": self.inits,
+                "init_units": "seconds since 1970-01-01 00:00:00", "step_units": "hours"}
+      tmpfile = "{:s}.part".format(self._header)
+      with open(tmpfile, "w") as fid: json.dump(header, fid)
+      os.rename(tmpfile, self._header)
+
+   def append(self, init, data, stations, params, times):
+      """append(init, data, stations, params, times)
+
+      Adds one model run. Stations, parameters, and forecast steps
+      missing in the model run are stored as NaN. Raises a ValueError
+      if the model run contains stations, parameters, or forecast
+      steps which are not in the archive (the axes of the archive are
+      fixed; nothing is added in this case). If the model run is already
+      in the archive the record is replaced.
+
+      Parameters
+      ----------
+      init : int
+         model initialization (seconds since 1970-01-01 00:00:00)
+      data : numpy.ndarray
+         interpolated data of dimension (station, param, time), see
+         interpolate_file
+      stations : list
+         names of the stations (first dimension of data)
+      params : list
+         names of the parameters (second dimension of data)
+      times : list
+         valid times (seconds since 1970-01-01 00:00:00; third dimension)
+
+      Returns
+      -------
+      Returns the index of the model run in the archive.
+      """
+      import numpy as np
+
+      init  = int(init)
+      steps = (np.asarray(times, dtype = np.float64) - init) / 3600.
+
+      # The axes of the archive are fixed: do not drop data silently
+      for name, new, axis in [("stations", [str(x) for x in stations], self.stations),
+                              ("parameters", [str(x) for x in params], self.params),
+                              ("forecast steps", [int(x) if x == int(x) else x for x in steps], self.steps)]:
+         new = [x for x in new if not x in axis]
+         if len(new) > 0:
+            raise ValueError("{:s} not in the archive {:s}: {:s}".format(name, self.directory,
+                             ", ".join([str(x) for x in new])))
+
+      rec   = np.full(self.shape[1:], np.nan, dtype = "<f4")
+      idx   = [(self.stations.index(str(x)) if str(x) in self.stations else None) for x in stations]
+      pdx   = [(self.params.index(str(x))   if str(x) in self.params   else None) for x in params]
+      tdx   = [(self.steps.index(x)         if x in self.steps         else None) for x in steps]
+      s = [i for i, x in enumerate(idx) if not x is None]
+      p = [i for i, x in enumerate(pdx) if not x is None]
+      t = [i for i, x in enumerate(tdx) if not x is None]
+      rec[np.ix_([idx[i] for i in s], [pdx[i] for i in p], [tdx[i] for i in t])] = \
+            np.asarray(data)[np.ix_(s, p, t)]
+
+      # Replace an existing record, or append (the header is written after
+      # the data; bytes after the last record in the header are dropped).
+      if init in self.inits:
+         k   = self.inits.index(init)
+         arr = self.data("r+")
+         arr[k] = rec
+         arr.flush()
+         del arr
+      else:
+         k = len(self.inits)
+         with open(self._data, "r+b") as fid:
+            fid.truncate(k * rec.nbytes)
+            fid.seek(k * rec.nbytes)
+            fid.write(rec.tobytes())
+         self.inits.append(init)
+         self._write_header()
+      return k
+
+   def data(self, mode = "r"):
+      """data(mode = "r")
+
+      Parameters
+      ----------
+      mode : str
+         mode used to open the file (see numpy.memmap)
+
+      Returns
+      -------
+      Returns the data as numpy.memmap of dimension (init, station, param,
+      step); None if the archive is empty.
+      """
+      import numpy as np
+      if len(self.inits) == 0: return None
+      return np.memmap(self._data, dtype = "<f4", mode = mode, shape = self.shape)
+
+   def get(self, station, param):
+      """get(station, param)
+
+      Parameters
+      ----------
+      station : str
+         name of the station
+      param : str
+         name of the parameter
+
+      Returns
+      -------
+      Returns a view (numpy.memmap) of dimension (init, step) containing
+      all model runs for this station and parameter (see also inits
+      and steps).
+      """
+      if not station in self.stations:
+         raise ValueError("station {:s} not in the archive".format(station))
+      if not param in self.params:
+         raise ValueError("parameter {:s} not in the archive".format(param))
+      return self.data()[:, self.stations.index(station), self.params.index(param), :]
+
+   def __repr__(self):
+      return "station_archive: {:s} ({:d} runs, {:d} stations, {:d} params, {:d} steps)".format(
+             self.directory, *self.shape)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+   import os
+   import re
+   import sys
+   import time
+   import argparse
+   import datetime as dt
+   from glob import glob
+
+   os.environ["TZ"] = "UTC"
+
+   # Parsing input args
+   parser = argparse.ArgumentParser(description = "Interpolate the combined GFS NetCDF files")
+   parser.add_argument("--stations", "-s", type = str, default = None,
+              help = "File with the stations (statnr; lon; lat). Default are the stations " + \
+                     "used in GFS_interpolate.R.")
+   parser.add_argument("--noneighbours", default = False, action = "store_true",
+              help = "Do not add the neighbouring locations (mospack/data/neighbourmask.csv).")
+   parser.add_argument("--archive", "-a", type = str, default = None,
+              help = "Directory of the station archive (see station_archive). If set, " + \
+                     "all interpolated model runs are added to the archive.")
+   args = vars(parser.parse_args())
+
+   # Directory with the NetCDF files and output directory
+   ncdir = "netcdf"
+   ipdir = "interpolated"
+
+   if not os.path.isdir(ipdir):
+      try:
+         os.makedirs(ipdir)
+      except Exception as e:
+         raise Exception(e)
+
+   # Stations
+   stations = STATIONS if args["stations"] is None else read_stations(args["stations"])
+   if not args["noneighbours"]: stations = neighbours(stations)
+   if not len(set([x[0] for x in stations])) == len(stations):
+      raise ValueError("statnr of the stations have to be unique")
+
+   # Interpolate all files
+   cache   = weights_cache(os.path.join(ipdir, "weights"))
+   archive = None
+   if not args["archive"] is None and \
+      os.path.isfile(os.path.join(args["archive"], station_archive.HEADER)):
+      archive = station_archive(args["archive"])
+   files   = sorted(glob(os.path.join(ncdir, "GFS_[0-9]*_[0-9]*_combined.nc")))
+   start   = time.time()
+   count   = 0
+   failed  = []
+   for ncfile in files:
+      date = re.findall("GFS_([0-9]{8}_[0-9]{4})_combined.nc$", ncfile)
+      if len(date) == 0: continue
+      date    = dt.datetime.strptime(date[0], "%Y%m%d_%H%M")
+      init    = int((date - dt.datetime(1970, 1, 1)).total_seconds())
+      outfile = get_output_file_name(ipdir, date)
+      if not os.path.isfile(outfile) or os.path.getmtime(outfile) < os.path.getmtime(ncfile):
+         print("* Interpolating GFS run {:s}".format(date.strftime("%Y-%m-%d %H UTC")))
+         interpolate_file(ncfile, outfile, stations, cache)
+         count += 1
+      elif args["archive"] is None or (not archive is None and init in archive.inits):
+         continue
+
+      # Adding the model run to the archive. The axes of a new archive
+      # are the stations, parameters, and forecast steps of the first run;
+      # runs which do not fit are reported (the archive is not modified).
+      if not args["archive"] is None:
+         import numpy as np
+         with np.load(outfile) as tmp:
+            res = dict([(x, tmp[x]) for x in tmp.files])
+         if archive is None:
+            archive = station_archive(args["archive"], res["station"], res["param"],
+                                      (res["time"] - init) / 3600.)
+         try:
+            archive.append(init, res["data"], res["station"], res["param"], res["time"])
+         except ValueError as e:
+            print("[!] GFS run {:s} not added: {:s}".format(date.strftime("%Y-%m-%d %H UTC"), str(e)))
+            failed.append(date)
+
+   print("Interpolated {:d} files ({:d} stations) in {:.1f}s".format(count, len(stations),
+         time.time() - start))
+   if not archive is None: print(archive)
+   if len(failed) > 0:
+      print("[!] {:d} model run(s) not added to the archive".format(len(failed)))
+      sys.exit(1)
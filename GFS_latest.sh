@@ -14,16 +14,12 @@
 
 N=5
 
-day=0
-while [ $day -le $N ] ; do
-    thedate=`date "+%Y-%m-%d" -d "${day}days ago"`
-    echo $thedate
-    printf "* TRYING TO DOWNLOAD %s\n" "${thedate}"
-    python GFS_download.py -r 0 -d ${thedate}
-
-    # Go one further into the past
-    let day=$day+1
-done
+# One call for the last N days (one process, the steps already
+# on disc are skipped).
+date1=`date "+%Y-%m-%d" -d "${N}days ago"`
+date2=`date "+%Y-%m-%d"`
+printf "* TRYING TO DOWNLOAD %s to %s\n" "${date1}" "${date2}"
+python GFS_download.py -r 0 --start ${date1} --end ${date2}
 
 #date1=`date "+%Y-%m-%d" -d "1days ago"`
 #date2=`date "+%Y-%m-%d" -d "2days ago"`
@@ -484,8 +484,8 @@ def show_tab(colnames, data, n = None):
 # -------------------------------------------------------------------
 class obs_db():
 
-    def __init__(self, sqlite3dir, file, colnames):
-        """obs_db(sqlite3dir, file)
+    def __init__(self, sqlite3dir, file, colnames, bulk = False, batch = 100000):
+        """obs_db(sqlite3dir, file, colnames, bulk = False, batch = 100000)
 
         Parameters
         ----------
@@ -497,6 +497,14 @@ class obs_db():
             list of the column names to be checked and, if not existing,
             being created. Currently each of them will be created as
             signed integer!
+        bulk : bool
+            bulk-load mode, used to import many files with one
+            connection: write-ahead log (WAL) and synchronous=NORMAL,
+            write does not commit; the rows are committed in large
+            transactions (every "batch" rows) and when calling commit
+            or close.
+        batch : int
+            number of rows per transaction in bulk mode
         """
 
         self._colnames = colnames
@@ -504,8 +512,18 @@ class obs_db():
         # Import and open connection
         import os
         import sqlite3
-        self._dbfile = os.path.join(sqlite3dir, file)
+        self._dbfile  = os.path.join(sqlite3dir, file)
+        self._bulk    = bulk
+        self._batch   = batch
+        self._pending = 0
+        self._rows    = 0
+        self._seconds = 0.
         self.con = sqlite3.connect(self.get("dbfile"))
+        if bulk:
+            self.con.execute("PRAGMA journal_mode=WAL;")
+            self.con.execute("PRAGMA synchronous=NORMAL;")
+            self.con.execute("PRAGMA temp_store=MEMORY;")
+            self.con.execute("PRAGMA cache_size=-65536;")
         self._check_create_table()
 
 
@@ -537,27 +555,75 @@ class obs_db():
 
         # Reading column names
         cnames = self.con.execute("PRAGMA table_info(obs);").fetchall()
-        cnames = [x[1] for x in cnames]
-
-        sql = []
-        for col in self.get("colnames"):
-            if not col in cnames:
-                self.con.execute("ALTER TABLE obs ADD COLUMN {:s} NUMERIC;".format(col))
+        self._cnames = [x[1] for x in cnames]
+        self._add_columns(self.get("colnames"))
 
         self.con.commit()
 
+    def _add_columns(self, colnames):
+        # Creates the columns not yet in the table (known columns
+        # are kept in self._cnames, no PRAGMA table_info per call).
+        for col in colnames:
+            if not col in self._cnames:
+                self.con.execute("ALTER TABLE obs ADD COLUMN {:s} NUMERIC;".format(col))
+                self._cnames.append(col)
+
     def write(self, colnames, data):
 
         if not "datumsec" in colnames:
             raise ValueError("\"datetime\" column missing!")
 
+        import time
+        start = time.time()
+        if self._bulk: self._add_columns(colnames)
 
         sql = "INSERT OR REPLACE INTO obs ({:s}) VALUES ({:s})".format(
                 ", ".join(colnames), ", ".join(["?"] * len(colnames)))
 
+        data = list(data)
         self.con.executemany(sql, data)
+        self._rows    += len(data)
+        self._pending += len(data)
+        if not self._bulk or self._pending >= self._batch:
+            self.con.commit()
+            self._pending = 0
+        self._seconds += time.time() - start
+
+    def commit(self):
+        """commit()
+
+        Commits the pending rows (bulk mode).
+        """
+        import time
+        start = time.time()
         self.con.commit()
-        
+        self._pending  = 0
+        self._seconds += time.time() - start
+
+    def close(self):
+        """close()
+
+        Commits the pending rows and closes the connection.
+        """
+        self.commit()
+        self.con.close()
+
+    def throughput(self):
+        """throughput()
+
+        Returns
+        -------
+        Returns a tuple with the number of rows written, the time spent
+        writing (seconds), and the number of rows per second.
+        """
+        return (self._rows, self._seconds,
+                self._rows / self._seconds if self._seconds > 0 else float("nan"))
+
+    def __repr__(self):
+        return "obs_db: {:s} ({:d} rows written in {:.2f}s, {:.0f} rows/s)".format(
+               self.get("dbfile"), *self.throughput())
+
+
 
 class read_obs_config():
 
@@ -656,6 +722,9 @@ if __name__ == "__main__":
     parser.add_argument("--devel", default = False, action = "store_true",
                help = "Used for development. If set, the script reads config_devel.conf" + \
                       " instead of config.conf.")
+    parser.add_argument("--bulk", "-b", default = False, action = "store_true",
+               help = "Bulk-load mode for backfilling: one database connection for all " + \
+                      "files (WAL, synchronous=NORMAL, large transactions).")
     args = vars(parser.parse_args())
 
     import sys
@@ -672,6 +741,9 @@ if __name__ == "__main__":
     # Number of days to download in one go
     ndays = 31
 
+    # Database connection (kept open for all files in bulk mode)
+    db = None
+
     # The year ...
     for year in range(2016, int(dt.date.today().strftime("%Y")) + 1):
 
@@ -766,13 +838,19 @@ if __name__ == "__main__":
         
             # Define and open sqlite3 database
             sql3file = "obs_{:d}.sqlite3".format(args["station"])
-            db = obs_db(config.get("sqlite3dir"), sql3file, colnames)
+            if db is None or not args["bulk"]:
+                db = obs_db(config.get("sqlite3dir"), sql3file, colnames, bulk = args["bulk"])
 
             db.write(colnames, data)
     
             # --------------------------------
             ##show_tab(colnames, data, n = 5)
 
+    # Commit the rows of the last transaction (bulk mode)
+    if not db is None and args["bulk"]:
+        db.close()
+        print(db)
+
 
 
 
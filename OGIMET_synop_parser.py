@@ -18,8 +18,8 @@ os.environ["TZ"] = "UTC"
 # -------------------------------------------------------------------
 class obs_db():
 
-    def __init__(self, sqlite3dir, file, colnames):
-        """obs_db(sqlite3dir, file)
+    def __init__(self, sqlite3dir, file, colnames, bulk = False, batch = 100000):
+        """obs_db(sqlite3dir, file, colnames, bulk = False, batch = 100000)
 
         Parameters
         ----------
@@ -31,6 +31,14 @@ class obs_db():
             list of the column names to be checked and, if not existing,
             being created. Currently each of them will be created as
             signed integer!
+        bulk : bool
+            bulk-load mode, used to import many files with one
+            connection: write-ahead log (WAL) and synchronous=NORMAL,
+            write does not commit; the rows are committed in large
+            transactions (every "batch" rows) and when calling commit
+            or close.
+        batch : int
+            number of rows per transaction in bulk mode
         """
 
         self._colnames = [x.lower() for x in colnames]
@@ -38,8 +46,18 @@ class obs_db():
         # Import and open connection
         import os
         import sqlite3
-        self._dbfile = os.path.join(sqlite3dir, file)
+        self._dbfile  = os.path.join(sqlite3dir, file)
+        self._bulk    = bulk
+        self._batch   = batch
+        self._pending = 0
+        self._rows    = 0
+        self._seconds = 0.
         self.con = sqlite3.connect(self.get("dbfile"))
+        if bulk:
+            self.con.execute("PRAGMA journal_mode=WAL;")
+            self.con.execute("PRAGMA synchronous=NORMAL;")
+            self.con.execute("PRAGMA temp_store=MEMORY;")
+            self.con.execute("PRAGMA cache_size=-65536;")
         self._check_create_table()
 
 
@@ -83,15 +101,19 @@ class obs_db():
 
         # Reading column names
         cnames = self.con.execute("PRAGMA table_info(obs);").fetchall()
-        cnames = [x[1] for x in cnames]
-
-        sql = []
-        for col in self.get("colnames"):
-            if not col in cnames:
-                self.con.execute("ALTER TABLE obs ADD COLUMN {:s} NUMERIC;".format(col))
+        self._cnames = [x[1] for x in cnames]
+        self._add_columns(self.get("colnames"))
 
         self.con.commit()
 
+    def _add_columns(self, colnames):
+        # Creates the columns not yet in the table (known columns
+        # are kept in self._cnames, no PRAGMA table_info per call).
+        for col in colnames:
+            if not col in self._cnames:
+                self.con.execute("ALTER TABLE obs ADD COLUMN {:s} NUMERIC;".format(col))
+                self._cnames.append(col)
+
     def write(self, colnames, data):
 
         if not "datumsec" in colnames:
@@ -99,12 +121,57 @@ class obs_db():
 
         colnames = [x.lower() for x in colnames]
 
+        import time
+        start = time.time()
+        if self._bulk: self._add_columns(colnames)
+
         sql = "INSERT OR REPLACE INTO obs ({:s}) VALUES ({:s})".format(
                 ", ".join(colnames), ", ".join(["?"] * len(colnames)))
 
+        data = list(data)
         self.con.executemany(sql, data)
+        self._rows    += len(data)
+        self._pending += len(data)
+        if not self._bulk or self._pending >= self._batch:
+            self.con.commit()
+            self._pending = 0
+        self._seconds += time.time() - start
+
+    def commit(self):
+        """commit()
+
+        Commits the pending rows (bulk mode).
+        """
+        import time
+        start = time.time()
         self.con.commit()
-        
+        self._pending  = 0
+        self._seconds += time.time() - start
+
+    def close(self):
+        """close()
+
+        Commits the pending rows and closes the connection.
+        """
+        self.commit()
+        self.con.close()
+
+    def throughput(self):
+        """throughput()
+
+        Returns
+        -------
+        Returns a tuple with the number of rows written, the time spent
+        writing (seconds), and the number of rows per second.
+        """
+        return (self._rows, self._seconds,
+                self._rows / self._seconds if self._seconds > 0 else float("nan"))
+
+    def __repr__(self):
+        return "obs_db: {:s} ({:d} rows written in {:.2f}s, {:.0f} rows/s)".format(
+               self.get("dbfile"), *self.throughput())
+
+
 
 class read_obs_config():
 
@@ -814,6 +881,9 @@ if __name__ == "__main__":
                help = "Process this one test file (development).")
     parser.add_argument("--latest", "-l", type = int, default = None,
                help = "For operational use, loads the latest N (input latest, int) days only.")
+    parser.add_argument("--bulk", "-b", default = False, action = "store_true",
+               help = "Bulk-load mode for backfilling: one database connection for all " + \
+                      "files (WAL, synchronous=NORMAL, large transactions).")
     parser.add_argument("--devel", default = False, action = "store_true",
                help = "Used for development. If set, the script reads config_devel.conf" + \
                       " instead of config.conf.")
@@ -840,6 +910,14 @@ if __name__ == "__main__":
         messages = get_synop_messages(args["testfile"])
         sys.exit(" --- development stop (--testfile) ---- ")
 
+    # Keep-alive HTTP session (from GFS_download.py) re-used for
+    # all monthly requests.
+    from GFS_download import http_session
+    session = http_session(timeout = 120, retries = 3, backoff = 30., max_per_host = 1)
+
+    # Database connection (kept open for all files in bulk mode)
+    db = None
+
     # The year ...
     for year in range(2014, int(dt.date.today().strftime("%Y")) + 1):
 
@@ -881,24 +959,20 @@ if __name__ == "__main__":
                     print("  - Latest {:d} days for {:d}".format(args["latest"], args["station"]))
                 print("  - URL: {:s}".format(url))
 
-                if PYTHON_VERSION <= 2:
-                    from urllib2 import urlopen
-                else:
-                    from urllib.request import urlopen
                 import time
                 counter = 0
                 while counter < 10:
 
                     ++counter;
 
-                    uid     = urlopen(url)
-                    content = uid.readlines()
+                    uid     = session.request(url)
+                    content = uid.read().splitlines(True)
+                    uid.close()
                     if len(content) == 0:
                         print("    No data for this request, create empy file")
                         fid = open(synfile, "w")
                         fid.close()
                         break;
-                    uid.close()
 
                     # Decoding bytes if needed (Py3)
                     if PYTHON_VERSION >= 3 and isinstance(content[0], bytes):
@@ -942,15 +1016,22 @@ if __name__ == "__main__":
             if len(data) > 0:
                 sql3file = "obs_{:d}.sqlite3".format(args["station"])
                 print("Write into {:s}".format(sql3file))
-                db = obs_db(config.get("sqlite3dir"), sql3file, colnames)
+                if db is None or not args["bulk"]:
+                    db = obs_db(config.get("sqlite3dir"), sql3file, colnames, bulk = args["bulk"])
                 db.write(colnames, data)
 
             # If only latest was requested, stop here.
             if args["latest"]:
+                if not db is None: db.close()
                 from os import remove
                 remove(synfile)
                 sys.exit(0)
 
+    # Commit the rows of the last transaction (bulk mode)
+    if not db is None and args["bulk"]:
+        db.close()
+        print(db)
+
 
 
 